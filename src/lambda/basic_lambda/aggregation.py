@@ -0,0 +1,65 @@
+CUSTOMER_NOT_FOUND = "Customer reference not found in customers."
+ORDER_NOT_FOUND = "Order reference not found in orders."
+
+
+def customer_message(customer_reference, orders, total_price):
+    return {
+        "type": "customer_message",
+        "customer_reference": customer_reference,
+        "orders": orders,
+        "total_price": total_price
+    }
+
+
+def missing_customer_error(customer_reference, order_reference):
+    return {
+        "type": "error_message",
+        "customer_reference": customer_reference,
+        "order_reference": order_reference,
+        "message": CUSTOMER_NOT_FOUND
+    }
+
+
+def missing_order_error(order_reference):
+    return {
+        "type": "error_message",
+        "customer_reference": None,
+        "order_reference": order_reference,
+        "message": ORDER_NOT_FOUND
+    }
+
+
+def summarize(customers, orders, items):
+    """Builds the customer summaries and error messages from the record tables.
+
+    Each table is walked exactly once: items are validated against the order
+    index and summed per order reference, then orders are validated against
+    the customer index and folded into the per-customer count and spend.
+    Returns ``(customer_messages, error_messages)``.
+    """
+    order_index = orders.index
+    order_totals = {}
+    get_order_total = order_totals.get
+    missing_order_errors = []
+    for order_reference, total_price in zip(items.order_references, items.total_prices):
+        if order_reference in order_index:
+            order_totals[order_reference] = get_order_total(order_reference, 0.0) + total_price
+        else:
+            missing_order_errors.append(missing_order_error(order_reference))
+
+    customer_index = customers.index
+    # customer_reference -> [orders, total_price]
+    summary = {}
+    missing_customer_errors = []
+    for order_reference, customer_reference in zip(orders.references, orders.customer_references):
+        if customer_reference in customer_index:
+            entry = summary.get(customer_reference)
+            if entry is None:
+                entry = summary[customer_reference] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += get_order_total(order_reference, 0.0)
+        else:
+            missing_customer_errors.append(missing_customer_error(customer_reference, order_reference))
+
+    customer_messages = [customer_message(k, v[0], v[1]) for k, v in summary.items()]
+    return customer_messages, missing_customer_errors + missing_order_errors
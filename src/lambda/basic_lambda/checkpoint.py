@@ -0,0 +1,91 @@
+import hashlib
+import logging
+
+from publishers import CUSTOMER_MESSAGE
+
+logger = logging.getLogger()
+
+# Idempotent publishing. A run that timed out halfway through publishing and
+# is retried would send every message again. With a checkpoint, a day's
+# messages are published in windows of CHECKPOINT_EVERY messages, and the
+# number sent so far is saved in the state store after each window:
+#
+#   publish:<date>:<destination>  {"run": r, "generation": g, "sent": {"1": n, "0": m}}
+#
+# The destination is the publisher's (e.g. sqs:<queue url>), so publishing a
+# day to another queue or broker starts from the beginning. r is a digest of
+# the encoded messages, so only a retry that produces the same messages
+# resumes at the first unsaved window; a run over changed inputs publishes
+# everything again. Messages of the window that was in flight when the run
+# died may still be sent twice.
+#
+# Every message also gets a dedup id from the run, the date and its
+# reference, which FIFO queues take as MessageDeduplicationId, so SQS drops
+# those resent copies too. A checkpoint created with reset=True ignores the
+# saved progress and starts generation g + 1, which changes r and with it
+# the dedup ids, so a deliberate re-send is not dropped either.
+CHECKPOINT_EVERY = 1000
+
+
+class PublishCheckpoint:
+    """Publish progress of one day in a state store from incremental.py."""
+
+    def __init__(self, store, file_date, every=CHECKPOINT_EVERY, reset=False):
+        self.store = store
+        self.file_date = file_date
+        self.every = every
+        self.reset = reset
+        self.key = None
+        self.run = None
+        self.generation = 0
+        self._sent = {}
+
+    def begin(self, encoded, destination):
+        # encoded maps each message kind to the encoded bodies of its
+        # messages; loads the progress saved for the same messages and
+        # destination, if any
+        self.key = f"publish:{self.file_date}:{destination}"
+        saved = self.store.get_many([self.key]).get(self.key)
+        self.generation = (saved or {}).get('generation', 0) + (1 if self.reset else 0)
+
+        digest = hashlib.sha256()
+        if self.generation:
+            digest.update(b'g%d;' % self.generation)
+        for status in sorted(encoded):
+            digest.update(b'%d:%d;' % (status, len(encoded[status])))
+            for body in encoded[status]:
+                digest.update(b'%d:' % len(body))
+                digest.update(body)
+        self.run = digest.hexdigest()[:16]
+
+        if not self.reset and saved is not None and saved['run'] == self.run:
+            self._sent = {int(status): sent for status, sent in saved['sent'].items()}
+            logger.info(f"Resuming publish of {self.file_date} after {sum(self._sent.values())} messages")
+        else:
+            self._sent = {}
+
+    def sent(self, status):
+        return self._sent.get(status, 0)
+
+    def save(self, status, sent):
+        self._sent[status] = sent
+        self.store.put_many({self.key: {'run': self.run, 'generation': self.generation,
+                                        'sent': {str(kind): count for kind, count in self._sent.items()}}})
+
+    def dedup_ids(self, status, messages):
+        # '<run>:<date>:<reference>' per message; a reference that repeats,
+        # e.g. in the errors for several items of one missing order, gets
+        # ':<n>' from its second message on
+        if status == CUSTOMER_MESSAGE:
+            references = [message['customer_reference'] for message in messages]
+            prefix = f"{self.run}:{self.file_date}:c:"
+        else:
+            references = [message['order_reference'] for message in messages]
+            prefix = f"{self.run}:{self.file_date}:e:"
+        seen = {}
+        ids = []
+        for reference in references:
+            count = seen.get(reference, 0)
+            seen[reference] = count + 1
+            ids.append(f"{prefix}{reference}:{count}" if count else f"{prefix}{reference}")
+        return ids
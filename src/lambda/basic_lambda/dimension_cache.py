@@ -0,0 +1,118 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from engines import load_and_close
+from s3_csv import open_s3_version
+
+logger = logging.getLogger()
+
+# The customers file changes slowly, but every invocation used to download it
+# and rebuild the customer index. DimensionCache keeps the loaded table in
+# memory across warm invocations and revalidates it with a conditional GET,
+# so an unchanged object costs a 304 response instead of a download and parse.
+#
+# Eviction is least recently used by object key, at most max_entries keys
+# (today's and yesterday's file by default). Tables are kept as the engine
+# loaded them, so an entry is only reused by the engine that built it.
+CUSTOMER_CACHE_ENTRIES = 2
+
+
+class _Entry:
+    __slots__ = ('etag', 'size', 'engine', 'table')
+
+    def __init__(self, etag, size, engine, table):
+        self.etag = etag
+        self.size = size
+        self.engine = engine
+        self.table = table
+
+
+class DimensionCache:
+    """LRU of loaded dimension tables keyed by (bucket, key), validated by ETag."""
+
+    def __init__(self, max_entries=CUSTOMER_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, bucket, key, etag, engine):
+        # Returns the cached table if it is the version etag names and was
+        # loaded by engine, else None
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+            if entry is None or entry.etag != etag or entry.engine != engine.name:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((bucket, key))
+            self.hits += 1
+            return entry.table
+
+    def put(self, bucket, key, etag, size, engine, table):
+        with self._lock:
+            self._entries[(bucket, key)] = _Entry(etag, size, engine.name, table)
+            self._entries.move_to_end((bucket, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def open(self, s3, bucket, key):
+        """GETs the object unless the cached version is still current.
+
+        Returns ``(stream, size, etag)``; stream is None when S3 answered 304
+        Not Modified to the conditional GET.
+        """
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+        if entry is None:
+            return open_s3_version(s3, bucket, key)
+        try:
+            return open_s3_version(s3, bucket, key, IfNoneMatch=entry.etag)
+        except ClientError as error:
+            if error.response['Error']['Code'] not in ('304', 'NotModified'):
+                raise
+        return None, entry.size, entry.etag
+
+    def load(self, engine, bucket, key, etag, size, load_table):
+        # Returns the cached table or load_table() for the version etag names,
+        # caching what was loaded
+        if not engine.in_memory:
+            return load_table()
+        table = self.get(bucket, key, etag, engine)
+        if table is not None:
+            logger.info(f"'{key}' {etag} reused from the warm container")
+            return table
+        table = load_table()
+        self.put(bucket, key, etag, size, engine, table)
+        return table
+
+
+def s3_load(cache, engine, kind, s3, bucket, key, opened, loader=None):
+    # Load callable for engines.summarize_loads, given the (stream, size,
+    # etag) that cache.open returned for the object. loader(open_stream)
+    # replaces the engine's load_<kind> for the table that is cached.
+    stream, size, etag = opened
+
+    def open_stream():
+        nonlocal stream
+        if stream is None:
+            # Not modified, but the cached table was built by another engine
+            stream = open_s3_version(s3, bucket, key, IfMatch=etag)[0]
+        return stream
+
+    def load_table():
+        if loader is not None:
+            return loader(open_stream)
+        return load_and_close(getattr(engine, f'load_{kind}'), open_stream())
+
+    def load():
+        try:
+            return cache.load(engine, bucket, key, etag, size, load_table)
+        finally:
+            if stream is not None:
+                stream.close()
+
+    return load
@@ -0,0 +1,342 @@
+import csv
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+
+from aggregation import (customer_message, missing_customer_error, missing_order_error,
+                         summarize)
+from import_timer import timed_import
+from metrics import Stage
+from records import Customers, Items, Orders
+from s3_csv import decompress, decompressed_size, iter_lines
+from spill import partition_customers, partition_items, partition_orders, summarize_partitions
+
+# Processing engines turn the three daily CSV streams into customer messages
+# and error messages. All engines produce the same messages: one summary per
+# known customer with the number of orders and the total spent over their
+# items, plus the orphan order and orphan item errors.
+#
+# pandas and pyarrow are imported when their engine is first created. 'auto'
+# keeps small days on the pure-python engine, which needs no heavy imports,
+# and moves days of AUTO_VECTORIZED_BYTES or more to pyarrow or
+# pandas, whichever is installed. Days whose inputs would take more than the
+# memory budget once loaded go to the 'external' engine, which spills them
+# to local disk (spill.py).
+AUTO_VECTORIZED_BYTES = 32 * 1024 * 1024
+# Loaded tables and indexes take several times the size of the CSV input
+IN_MEMORY_EXPANSION = 4
+# Share of the function's (or machine's) memory the loaded tables may use
+MEMORY_BUDGET_FRACTION = 0.5
+
+ENGINES = {}
+_engine_instances = {}
+
+
+def register_engine(name):
+    def decorator(cls):
+        cls.name = name
+        ENGINES[name] = cls
+        return cls
+    return decorator
+
+
+def is_available(module):
+    # Checks for an optional dependency without paying for its import
+    return importlib.util.find_spec(module) is not None
+
+
+def memory_budget():
+    # Bytes the in-memory engines may fill: a share of the Lambda memory
+    # size, or of the machine's memory when run locally
+    memory_mb = os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE')
+    if memory_mb:
+        memory = int(memory_mb) * 1024 * 1024
+    else:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return int(memory * MEMORY_BUDGET_FRACTION)
+
+
+def select_engine(total_bytes):
+    if total_bytes * IN_MEMORY_EXPANSION > memory_budget():
+        return 'external'
+    if total_bytes >= AUTO_VECTORIZED_BYTES:
+        for name, module in (('pyarrow', 'pyarrow'), ('pandas', 'pandas')):
+            if is_available(module):
+                return name
+    return 'python'
+
+
+def get_engine(name='auto', total_bytes=0):
+    if name == 'auto':
+        name = select_engine(total_bytes)
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine '{name}', expected 'auto' or one of {sorted(ENGINES)}")
+    if name not in _engine_instances:
+        _engine_instances[name] = ENGINES[name]()
+    return _engine_instances[name]
+
+
+class Engine:
+    """Loads each input from a binary stream, then summarizes the loaded inputs.
+
+    The three ``load_*`` calls run side by side on worker threads, so they
+    must not share state.
+    """
+
+    name = None
+    # False when loaded tables are files that summarize consumes; those are
+    # not kept in the dimension or parsed-input caches
+    in_memory = True
+
+    def load_customers(self, stream):
+        raise NotImplementedError
+
+    def load_orders(self, stream):
+        raise NotImplementedError
+
+    def load_items(self, stream):
+        raise NotImplementedError
+
+    def summarize(self, customers, orders, items):
+        # Returns (customer_messages, error_messages)
+        raise NotImplementedError
+
+    def to_arrow(self, kind, table, schema):
+        # Converts a loaded table to an Arrow table with the given schema, for
+        # the parsed-input cache. kind is 'customers', 'orders' or 'items'.
+        raise NotImplementedError
+
+    def from_arrow(self, kind, table):
+        raise NotImplementedError
+
+
+@register_engine('python')
+class PythonEngine(Engine):
+    # Streams rows through csv.reader into the column tables in records.py
+
+    def load_customers(self, stream):
+        return Customers.from_csv(csv.reader(iter_lines(stream)))
+
+    def load_orders(self, stream):
+        return Orders.from_csv(csv.reader(iter_lines(stream)))
+
+    def load_items(self, stream):
+        return Items.from_csv(csv.reader(iter_lines(stream)))
+
+    def summarize(self, customers, orders, items):
+        return summarize(customers, orders, items)
+
+    def to_arrow(self, kind, table, schema):
+        pa = timed_import('pyarrow')
+        if kind == 'customers':
+            columns = {'customer_reference': table.references}
+        elif kind == 'orders':
+            columns = {'customer_reference': table.customer_references, 'order_reference': table.references}
+        else:
+            columns = {'order_reference': table.order_references, 'total_price': table.total_prices}
+        return pa.table(columns, schema=schema)
+
+    def from_arrow(self, kind, table):
+        if kind == 'customers':
+            loaded = Customers()
+            for customer_reference in table['customer_reference'].to_pylist():
+                loaded.append(customer_reference)
+        elif kind == 'orders':
+            loaded = Orders()
+            for row in zip(table['order_reference'].to_pylist(), table['customer_reference'].to_pylist()):
+                loaded.append(*row)
+        else:
+            loaded = Items()
+            for row in zip(table['order_reference'].to_pylist(), table['total_price'].to_pylist()):
+                loaded.append(*row)
+        return loaded
+
+
+@register_engine('pandas')
+class PandasEngine(Engine):
+    # Reads only the needed columns and aggregates with isin/groupby, without
+    # ever joining the frames
+
+    def __init__(self):
+        self.pd = timed_import('pandas')
+
+    def load_customers(self, stream):
+        return self.pd.read_csv(stream, usecols=['customer_reference'], dtype=str)
+
+    def load_orders(self, stream):
+        return self.pd.read_csv(stream, usecols=['order_reference', 'customer_reference'], dtype=str)
+
+    def load_items(self, stream):
+        return self.pd.read_csv(stream, usecols=['order_reference', 'total_price'],
+                                dtype={'order_reference': str, 'total_price': 'float64'})
+
+    def summarize(self, customers, orders, items):
+        customer_found = orders['customer_reference'].isin(customers['customer_reference'])
+        order_found = items['order_reference'].isin(orders['order_reference'])
+
+        order_totals = (
+            items['total_price'][order_found]
+            .groupby(items['order_reference'][order_found], sort=False)
+            .sum()
+        )
+        known_orders = orders[customer_found]
+        summary = (
+            self.pd.DataFrame({
+                'customer_reference': known_orders['customer_reference'].to_numpy(),
+                'total_price': order_totals.reindex(known_orders['order_reference']).fillna(0.0).to_numpy(),
+            })
+            .groupby('customer_reference', sort=False)['total_price']
+            .agg(['size', 'sum'])
+        )
+
+        customer_messages = [customer_message(*row) for row in zip(
+            summary.index.tolist(), summary['size'].tolist(), summary['sum'].tolist())]
+        missing_orders = orders[~customer_found]
+        error_messages = [missing_customer_error(*row) for row in zip(
+            missing_orders['customer_reference'].tolist(), missing_orders['order_reference'].tolist())]
+        error_messages += [missing_order_error(ref) for ref in items['order_reference'][~order_found].tolist()]
+        return customer_messages, error_messages
+
+    def to_arrow(self, kind, table, schema):
+        pa = timed_import('pyarrow')
+        return pa.Table.from_pandas(table, schema=schema, preserve_index=False)
+
+    def from_arrow(self, kind, table):
+        return table.to_pandas()
+
+
+@register_engine('pyarrow')
+class PyarrowEngine(Engine):
+    # Multithreaded CSV reader and Arrow compute kernels; optional dependency
+
+    def __init__(self):
+        self.pa = timed_import('pyarrow')
+        self.pc = timed_import('pyarrow.compute')
+        self.csv = timed_import('pyarrow.csv')
+
+    def _read(self, stream, column_types):
+        return self.csv.read_csv(stream, convert_options=self.csv.ConvertOptions(
+            include_columns=list(column_types), column_types=column_types))
+
+    def load_customers(self, stream):
+        return self._read(stream, {'customer_reference': self.pa.string()})
+
+    def load_orders(self, stream):
+        return self._read(stream, {'order_reference': self.pa.string(),
+                                   'customer_reference': self.pa.string()})
+
+    def load_items(self, stream):
+        return self._read(stream, {'order_reference': self.pa.string(),
+                                   'total_price': self.pa.float64()})
+
+    def summarize(self, customers, orders, items):
+        pa, pc = self.pa, self.pc
+        customer_found = pc.is_in(orders['customer_reference'], value_set=customers['customer_reference'])
+        order_found = pc.is_in(items['order_reference'], value_set=orders['order_reference'])
+
+        order_totals = items.filter(order_found).group_by('order_reference', use_threads=False) \
+            .aggregate([('total_price', 'sum')])
+        known_orders = orders.filter(customer_found)
+        positions = pc.index_in(known_orders['order_reference'], value_set=order_totals['order_reference'])
+        totals = pc.fill_null(pc.take(order_totals['total_price_sum'], positions), 0.0)
+        summary = pa.table({'customer_reference': known_orders['customer_reference'], 'total_price': totals}) \
+            .group_by('customer_reference', use_threads=False) \
+            .aggregate([('total_price', 'count'), ('total_price', 'sum')])
+        # Hash grouping does not keep first-seen order; restore it so every
+        # engine emits customers in the order their first order appears
+        first_seen = pc.index_in(summary['customer_reference'], value_set=known_orders['customer_reference'])
+        summary = summary.take(pc.sort_indices(first_seen))
+
+        customer_messages = [customer_message(*row) for row in zip(
+            summary['customer_reference'].to_pylist(), summary['total_price_count'].to_pylist(),
+            summary['total_price_sum'].to_pylist())]
+        missing_orders = orders.filter(pc.invert(customer_found))
+        error_messages = [missing_customer_error(*row) for row in zip(
+            missing_orders['customer_reference'].to_pylist(), missing_orders['order_reference'].to_pylist())]
+        error_messages += [missing_order_error(ref) for ref in
+                           items.filter(pc.invert(order_found))['order_reference'].to_pylist()]
+        return customer_messages, error_messages
+
+    def to_arrow(self, kind, table, schema):
+        return table.select(schema.names).cast(schema)
+
+    def from_arrow(self, kind, table):
+        # Memory-mapped tables are used as they are, without a copy
+        return table
+
+
+@register_engine('external')
+class ExternalEngine(Engine):
+    # Hash-partitions the inputs into files under /tmp and aggregates one
+    # partition at a time, for days that do not fit in memory
+
+    in_memory = False
+
+    def load_customers(self, stream):
+        return partition_customers(stream)
+
+    def load_orders(self, stream):
+        return partition_orders(stream)
+
+    def load_items(self, stream):
+        return partition_items(stream)
+
+    def summarize(self, customers, orders, items):
+        return summarize_partitions(customers, orders, items)
+
+
+def load_and_close(loader, stream):
+    try:
+        return loader(stream)
+    finally:
+        stream.close()
+
+
+def process(engine, customers_stream, orders_stream, items_stream, executor=None, metrics=None):
+    # Loads the three streams side by side, closes them and summarizes
+    return summarize_loads(engine, (partial(load_and_close, engine.load_customers, customers_stream),
+                                    partial(load_and_close, engine.load_orders, orders_stream),
+                                    partial(load_and_close, engine.load_items, items_stream)),
+                           executor=executor, metrics=metrics)
+
+
+def summarize_loads(engine, loads, executor=None, metrics=None):
+    # Runs the three callables that load customers, orders and items side by
+    # side and summarizes their tables. With an InvocationMetrics, the loads
+    # are timed as the 'parse' stage and the fused validation and
+    # aggregation pass as 'summarize'.
+    def stage(name):
+        return metrics.stage(name) if metrics is not None else nullcontext(Stage(name))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=3)
+    try:
+        with stage('parse') as parse:
+            futures = [executor.submit(load) for load in loads]
+            try:
+                tables = tuple(future.result() for future in futures)
+            except BaseException:
+                if not engine.in_memory:
+                    # Drop the spilled inputs that did load
+                    for future in futures:
+                        if not future.cancelled() and future.exception() is None:
+                            future.result().remove()
+                raise
+            parse.rows = sum(len(table) for table in tables)
+        with stage('summarize') as summarize_stage:
+            result = engine.summarize(*tables)
+            summarize_stage.rows = parse.rows
+        return result
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def process_files(customer_file, orders_file, items_file, engine='auto'):
+    # Local-file entry point for the scripts in src/lambda/codes/python
+    paths = (customer_file, orders_file, items_file)
+    engine = get_engine(engine, sum(decompressed_size(path, os.path.getsize(path)) for path in paths))
+    return process(engine, *(decompress(open(path, 'rb'), path) for path in paths))
@@ -0,0 +1,67 @@
+import importlib
+import json
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Init time we are willing to spend on imports before warning about it
+IMPORT_BUDGET_MS = 1000
+
+# Milliseconds spent importing each dependency, in import order
+IMPORT_TIMES = {}
+_reported = set()
+_init = {}
+_lock = threading.Lock()
+
+
+def timed_import(name):
+    # Imports a dependency and records how long it took; modules that were
+    # already loaded are not recorded. import_module, unlike a look-up in
+    # sys.modules, waits for an import another thread has in progress
+    # instead of returning the partially initialized module.
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        with _lock:
+            IMPORT_TIMES.setdefault(name, (time.perf_counter() - start) * 1000)
+    return module
+
+
+def record_init(started):
+    # Called at the end of module init with the perf_counter() value taken at
+    # its start, so the report can show what the imports did not account for
+    _init['init_ms'] = (time.perf_counter() - started) * 1000
+
+
+def import_report(budget_ms=IMPORT_BUDGET_MS):
+    with _lock:
+        times = dict(IMPORT_TIMES)
+    imports_ms = sum(times.values())
+    report = {
+        'imports_ms': {name: round(ms, 1) for name, ms in times.items()},
+        'imports_total_ms': round(imports_ms, 1),
+        'budget_ms': budget_ms,
+        'over_budget': imports_ms > budget_ms,
+    }
+    if 'init_ms' in _init:
+        report['init_ms'] = round(_init['init_ms'], 1)
+    return report
+
+
+def log_import_report(budget_ms=IMPORT_BUDGET_MS):
+    # Logs the report once for the cold start and again only when a lazily
+    # imported backend (e.g. pandas for a large day) added to it
+    with _lock:
+        names = set(IMPORT_TIMES)
+    if names <= _reported:
+        return
+    _reported.update(names)
+    report = import_report(budget_ms)
+    if report['over_budget']:
+        logger.warning(f"Import time over budget: {json.dumps(report)}")
+    else:
+        logger.info(f"Import time: {json.dumps(report)}")
@@ -0,0 +1,437 @@
+import csv
+import dbm
+import fcntl
+import json
+import logging
+import re
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from itertools import chain, islice
+from urllib.parse import unquote_plus
+
+import boto3
+from botocore.exceptions import ClientError
+
+from aggregation import customer_message, missing_customer_error, missing_order_error
+from records import Customers, Items, Orders
+from s3_csv import read_csv_from_s3
+
+logger = logging.getLogger()
+
+# Incremental mode applies newly uploaded customers_/orders_/items_<date>.csv
+# [.gz|.zst] files as deltas against a persisted per-customer state, so an
+# intraday upload costs O(delta) instead of a recompute of the whole day.
+# The state of each day is kept apart, so the published totals are those the
+# daily recompute of that day would give. State keys:
+#
+#   customer:<date>:<ref>  {"orders": n, "total_price": t}  for every known customer
+#   order:<date>:<ref>     {"customer_reference": c, "total_price": t}  items
+#                          summed so far; customer_reference is None while
+#                          only items of the order have arrived
+#   orphans:<date>:<ref>   order references seen before customer <ref> existed
+#   object:<key>           {"etag": e, "rows": n}  the version of every object
+#                          applied and the number of its rows applied so far
+#   journal:<key>[:<n>]    the state changes of the last delta of the object
+#
+# An object uploaded again under the same key is taken to have rows
+# appended: only the rows after the ones already applied are applied, so a
+# redelivered notification or a grown items file never counts a row twice.
+# Objects that are rewritten otherwise must be uploaded under a new key.
+#
+# The changes of a delta are first written to the journal, in chunks of
+# JOURNAL_CHUNK entries followed by a header that commits them, and only then
+# to the state keys and the object marker. A run that stops in between is
+# completed by the next event for the object, which writes the journalled
+# values again; they are absolute values, so writing them twice is harmless.
+#
+# The journal also serves as the outbox of the delta's messages. Its header
+# says "published": false until confirm_published is called after the
+# messages went out. A retry of an event whose publish failed finds the
+# delta applied but not published and sends its messages again, with the
+# customers' current totals, instead of skipping it.
+#
+# Each delta reads state keys, changes them and writes them back, and S3
+# invokes the function once per object, so the three files of a day arrive
+# at the same time. The handler therefore holds a per-date lock in the store
+# (see locked) from applying an event through confirming its publish.
+
+DELTA_KEY = re.compile(r'(?:^|/)(customers|orders|items)_([^/]*?)\.csv(?:\.gz|\.gzip|\.zst|\.zstd)?$')
+# State entries or error messages per journal item, well under the 400 KB
+# DynamoDB item limit
+JOURNAL_CHUNK = 500
+
+# Deltas of one event are applied in this order so an upload of all three
+# files behaves like the full recompute
+DELTA_ORDER = {'customers': 0, 'orders': 1, 'items': 2}
+
+# A lock is taken over once it is older than the longest Lambda run; a
+# waiter gives up after LOCK_WAIT seconds and the invocation is retried
+LOCK_TTL = 900
+LOCK_WAIT = 300
+
+STATE_STORES = {}
+_store_instances = {}
+
+
+def register_state_store(name):
+    def decorator(cls):
+        STATE_STORES[name] = cls
+        return cls
+    return decorator
+
+
+def get_state_store(name, **config):
+    if name not in _store_instances:
+        if name not in STATE_STORES:
+            raise ValueError(f"Unknown state store '{name}', expected one of {sorted(STATE_STORES)}")
+        _store_instances[name] = STATE_STORES[name](**config)
+    return _store_instances[name]
+
+
+@register_state_store('local')
+class LocalStateStore:
+    """dbm file on local disk; stand-in for DynamoDB in tests and local runs."""
+
+    def __init__(self, path='/tmp/summary_state.db'):
+        self.path = path
+
+    def get_many(self, keys):
+        with dbm.open(self.path, 'c') as db:
+            return {key: json.loads(db[key]) for key in set(keys) if key in db}
+
+    def put_many(self, values):
+        with dbm.open(self.path, 'c') as db:
+            for key, value in values.items():
+                db[key] = json.dumps(value)
+
+    @contextmanager
+    def lock(self, name, wait=LOCK_WAIT):
+        # An flock on a file beside the dbm file, for the processes of one host
+        with open(f'{self.path}.lock-{name}', 'a') as f:
+            deadline = time.monotonic() + wait
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"State lock '{name}' still held after {wait}s")
+                    time.sleep(0.05)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@register_state_store('dynamodb')
+class DynamoDBStateStore:
+    """Table with a string partition key 'pk' and the JSON state in 'value'."""
+
+    BATCH_GET_LIMIT = 100
+
+    def __init__(self, table_name, resource=None):
+        self.table_name = table_name
+        self.resource = resource or boto3.resource('dynamodb')
+        self.table = self.resource.Table(table_name)
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        result = {}
+        for start in range(0, len(keys), self.BATCH_GET_LIMIT):
+            request = {self.table_name: {'Keys': [{'pk': key} for key in keys[start:start + self.BATCH_GET_LIMIT]]}}
+            while request:
+                response = self.resource.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.table_name, []):
+                    result[item['pk']] = json.loads(item['value'])
+                request = response.get('UnprocessedKeys')
+        return result
+
+    def put_many(self, values):
+        with self.table.batch_writer() as batch:
+            for key, value in values.items():
+                batch.put_item(Item={'pk': key, 'value': json.dumps(value)})
+
+    @contextmanager
+    def lock(self, name, wait=LOCK_WAIT, ttl=LOCK_TTL):
+        # A lock:<name> item written only if absent or expired, and deleted
+        # again only by its owner
+        key = f'lock:{name}'
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        delay = 0.05
+        while True:
+            now = int(time.time())
+            try:
+                self.table.put_item(Item={'pk': key, 'owner': owner, 'expires': now + ttl},
+                                    ConditionExpression='attribute_not_exists(pk) OR #expires < :now',
+                                    ExpressionAttributeNames={'#expires': 'expires'},
+                                    ExpressionAttributeValues={':now': now})
+                break
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"State lock '{name}' still held after {wait}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        try:
+            yield
+        finally:
+            try:
+                self.table.delete_item(Key={'pk': key}, ConditionExpression='#owner = :owner',
+                                       ExpressionAttributeNames={'#owner': 'owner'},
+                                       ExpressionAttributeValues={':owner': owner})
+            except ClientError as error:
+                # Taken over after it expired
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+
+def is_s3_event(event):
+    # True for any S3 notification, including removals and keys that are
+    # not deltas
+    return any(record.get('eventSource') == 'aws:s3' for record in (event or {}).get('Records', []))
+
+
+def parse_s3_event(event):
+    # Returns (bucket, key, etag, kind, date) for every created customers_/
+    # orders_/items_ object in an S3 notification, in the order deltas are
+    # applied
+    deltas = []
+    for record in (event or {}).get('Records', []):
+        if record.get('eventSource') != 'aws:s3' or not record.get('eventName', '').startswith('ObjectCreated'):
+            continue
+        key = unquote_plus(record['s3']['object']['key'])
+        match = DELTA_KEY.search(key)
+        if match:
+            deltas.append((record['s3']['bucket']['name'], key,
+                           record['s3']['object'].get('eTag', ''), match.group(1), match.group(2)))
+    return sorted(deltas, key=lambda delta: DELTA_ORDER[delta[3]])
+
+
+@contextmanager
+def locked(store, deltas):
+    """Holds the store's lock of every date the deltas belong to."""
+    with ExitStack() as stack:
+        # Always in date order, so two events cannot wait for each other
+        for file_date in sorted({file_date for _, _, _, _, file_date in deltas}):
+            stack.enter_context(store.lock(f'date:{file_date}'))
+        yield
+
+
+class _State:
+    # The slice of the store one event touches, with the keys it changed
+
+    def __init__(self, store):
+        self.store = store
+        self.values = {}
+        # Changed keys in the order they first changed
+        self.dirty = {}
+
+    def load(self, keys):
+        missing = [key for key in keys if key not in self.values]
+        if missing:
+            self.values.update(self.store.get_many(missing))
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def put(self, key, value):
+        self.values[key] = value
+        self.dirty[key] = None
+
+    def changes(self):
+        return {key: self.values[key] for key in self.dirty}
+
+
+def apply_deltas(store, file_date, customers=None, orders=None, items=None):
+    """Works out the state changes that new rows of one day make.
+
+    Returns ``(values, error_messages)``: the new value of every state key
+    the rows change, to be written with ``commit``, and the errors found in
+    the rows. Nothing is written to the store.
+    """
+    customers = customers or Customers()
+    orders = orders or Orders()
+    items = items or Items()
+
+    def customer_key(reference):
+        return f'customer:{file_date}:{reference}'
+
+    def order_key(reference):
+        return f'order:{file_date}:{reference}'
+
+    def orphans_key(reference):
+        return f'orphans:{file_date}:{reference}'
+
+    state = _State(store)
+    state.load([customer_key(ref) for ref in customers.references]
+               + [orphans_key(ref) for ref in customers.references]
+               + [customer_key(ref) for ref in orders.customer_references]
+               + [order_key(ref) for ref in orders.references]
+               + [order_key(ref) for ref in items.order_references])
+    # Items reach their customer through stored orders
+    state.load({customer_key(order['customer_reference'])
+                for order in (state.get(order_key(ref)) for ref in set(items.order_references))
+                if order is not None and order['customer_reference'] is not None})
+    errors = []
+
+    def add_to_customer(customer_reference, orders_added, total_price):
+        key = customer_key(customer_reference)
+        summary = state.get(key)
+        summary['orders'] += orders_added
+        summary['total_price'] += total_price
+        state.put(key, summary)
+
+    for customer_reference in customers.references:
+        key = customer_key(customer_reference)
+        if state.get(key) is not None:
+            continue
+        # Like the full summary, a customer without orders is not published
+        state.put(key, {'orders': 0, 'total_price': 0.0})
+        # Orders that arrived before their customer now count for it
+        orphans = state.get(orphans_key(customer_reference))
+        if orphans:
+            state.load([order_key(ref) for ref in orphans])
+            for order_reference in orphans:
+                add_to_customer(customer_reference, 1, state.get(order_key(order_reference))['total_price'])
+            state.put(orphans_key(customer_reference), [])
+
+    for order_reference, customer_reference in zip(orders.references, orders.customer_references):
+        key = order_key(order_reference)
+        order = state.get(key)
+        if order is not None and order['customer_reference'] is not None:
+            logger.warning(f"Order '{order_reference}' was already applied, ignoring it")
+            continue
+        # Items of the order may have arrived first
+        total_price = order['total_price'] if order is not None else 0.0
+        state.put(key, {'customer_reference': customer_reference, 'total_price': total_price})
+        if state.get(customer_key(customer_reference)) is not None:
+            add_to_customer(customer_reference, 1, total_price)
+        else:
+            errors.append(missing_customer_error(customer_reference, order_reference))
+            state.load([orphans_key(customer_reference)])
+            state.put(orphans_key(customer_reference),
+                      (state.get(orphans_key(customer_reference)) or []) + [order_reference])
+
+    for order_reference, total_price in zip(items.order_references, items.total_prices):
+        key = order_key(order_reference)
+        order = state.get(key) or {'customer_reference': None, 'total_price': 0.0}
+        order['total_price'] += total_price
+        state.put(key, order)
+        if order['customer_reference'] is None:
+            errors.append(missing_order_error(order_reference))
+        elif state.get(customer_key(order['customer_reference'])) is not None:
+            add_to_customer(order['customer_reference'], 0, total_price)
+
+    return state.changes(), errors
+
+
+def customer_messages_of(values):
+    # Messages for the changed customers among state values; like the full
+    # summary, customers without orders are left out
+    return [customer_message(key.split(':', 2)[2], summary['orders'], summary['total_price'])
+            for key, summary in values.items() if key.startswith('customer:') and summary['orders']]
+
+
+def commit(store, key, values, errors, applied):
+    """Writes the changes of one delta of object ``key`` through its journal.
+
+    ``applied`` is the object marker to write with them, ``{"etag": e,
+    "rows": n}``.
+    """
+    entries = list(values.items())
+    chunks = max(1, -(-len(entries) // JOURNAL_CHUNK), -(-len(errors) // JOURNAL_CHUNK))
+    store.put_many({f'journal:{key}:{n}': {
+        'values': dict(entries[n * JOURNAL_CHUNK:(n + 1) * JOURNAL_CHUNK]),
+        'errors': errors[n * JOURNAL_CHUNK:(n + 1) * JOURNAL_CHUNK],
+    } for n in range(chunks)})
+    # The header is the commit point; a run that stops after it is replayed
+    store.put_many({f'journal:{key}': {'applied': applied, 'chunks': chunks, 'published': False}})
+    store.put_many({**values, f'object:{key}': applied})
+
+
+def read_journal(store, key, journal):
+    # Returns the journalled (values, errors) of the last delta of key
+    chunks = store.get_many([f'journal:{key}:{n}' for n in range(journal['chunks'])])
+    values = {}
+    errors = []
+    for n in range(journal['chunks']):
+        values.update(chunks[f'journal:{key}:{n}']['values'])
+        errors.extend(chunks[f'journal:{key}:{n}']['errors'])
+    return values, errors
+
+
+def replay(store, key, journal):
+    # Writes the journalled changes of a delta whose run stopped after its
+    # commit point; returns them as (values, errors)
+    values, errors = read_journal(store, key, journal)
+    store.put_many({**values, f'object:{key}': journal['applied']})
+    return values, errors
+
+
+def confirm_published(store, deltas):
+    """Records that the messages of the deltas ``process_event`` returned
+    were published, so a later event for the same objects does not send
+    them again."""
+    keys = [f'journal:{key}' for _, key, _, _, _ in deltas]
+    journals = store.get_many(keys)
+    store.put_many({key: {**journal, 'published': True}
+                    for key, journal in journals.items() if not journal.get('published', True)})
+
+
+def process_event(s3, store, deltas):
+    """Downloads the delta objects of one S3 event and applies them in order.
+
+    Rows of an object that were already applied are skipped, so a
+    redelivered notification publishes nothing and an object uploaded again
+    with rows appended applies only the new rows. The returned messages must
+    be published before ``confirm_published`` is called for the deltas;
+    until then, every event for the objects returns their messages again.
+    """
+    keys = [key for _, key, _, _, _ in deltas]
+    saved = store.get_many([f'object:{key}' for key in keys] + [f'journal:{key}' for key in keys])
+    loaders = {'customers': Customers.from_csv, 'orders': Orders.from_csv, 'items': Items.from_csv}
+    customer_messages = {}
+    error_messages = []
+
+    def publish(values, errors):
+        # A customer changed by several deltas is published once, with its latest summary
+        customer_messages.update((message['customer_reference'], message) for message in customer_messages_of(values))
+        error_messages.extend(errors)
+
+    for bucket, key, etag, kind, file_date in deltas:
+        applied = saved.get(f'object:{key}')
+        if not isinstance(applied, dict):
+            # Markers of earlier versions held only the ETag, for undated state
+            applied = None
+        journal = saved.get(f'journal:{key}')
+        if journal is not None and journal['applied'] != applied:
+            logger.info(f"Completing the last delta of '{key}' from its journal")
+            publish(*replay(store, key, journal))
+            applied = journal['applied']
+        elif journal is not None and not journal.get('published', True):
+            logger.info(f"Sending the messages of the last delta of '{key}' again, they were not confirmed")
+            values, errors = read_journal(store, key, journal)
+            # The customers' current totals, which later deltas may have changed
+            customer_keys = [name for name in values if name.startswith('customer:')]
+            publish({**values, **store.get_many(customer_keys)}, errors)
+        if etag and applied is not None and applied['etag'] == etag:
+            logger.info(f"'{key}' ({etag}) was already applied, skipping it")
+            continue
+
+        offset = applied['rows'] if applied is not None else 0
+        # Blank lines are not rows, so they must not count towards offset
+        rows = (row for row in read_csv_from_s3(s3, bucket, key, reader=csv.reader) if row)
+        header = next(rows, None)
+        skipped = sum(1 for _ in islice(rows, offset))
+        if skipped < offset:
+            logger.warning(f"'{key}' has {skipped} rows but {offset} were applied from it before; "
+                           f"only rows appended to an object are applied")
+        table = loaders[kind](chain([header] if header is not None else [], rows), key)
+        values, errors = apply_deltas(store, file_date, **{kind: table})
+        applied = {'etag': etag, 'rows': offset + len(table)}
+        commit(store, key, values, errors, applied)
+        publish(values, errors)
+    return list(customer_messages.values()), error_messages
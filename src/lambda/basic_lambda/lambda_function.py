@@ -1,181 +1,278 @@
+import time
+_init_started = time.perf_counter()
+
 import datetime
-from io import StringIO
 import json
-import boto3
 import logging
-import time
-import csv
-import pika
-import paho.mqtt.client as mqtt
-from collections import defaultdict
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from import_timer import log_import_report, record_init, timed_import
+boto3 = timed_import('boto3')
+from botocore.config import Config
+from dimension_cache import DimensionCache, s3_load
+from engines import get_engine, is_available, load_and_close, summarize_loads
+from checkpoint import PublishCheckpoint
+from incremental import (confirm_published, get_state_store, is_s3_event, locked, parse_s3_event,
+                         process_event)
+from parsed_cache import PARSED_CACHE_PREFIX, get_parsed_cache, s3_loads
+from sharding import (SHARD_PREFIX, delete_shards, invoke_workers, is_internal_upload, merge, read_partials,
+                      split, summarize_s3_shard, upload_shards)
+from publishers import PackingPublisher, get_publisher, publish_messages
+from reference_index import REFERENCE_INDEX_PREFIX, get_reference_index_cache
+from metrics import InvocationMetrics
+from s3_csv import S3_MAX_POOL_CONNECTIONS, decompressed_size, open_s3_object
 
 messageQueueType = 'sqs'
+# None sends one message per record; 'ndjson' or 'msgpack' packs many records
+# into each queue message (see packing.py)
+packFormat = None
+# 'auto' picks an engine by input size, or one of 'python', 'pandas', 'pyarrow', 'external'
+processingEngine = 'auto'
+# Suffix of the daily input keys; '.csv.gz' or '.csv.zst' for compressed
+# inputs, which are also recognised by their Content-Encoding
+inputSuffix = '.csv'
+# Dumps every customer and error message to the logs; for debugging only
+verboseLogging = os.environ.get('VERBOSE_LOGGING', '').lower() in ('1', 'true')
+queue_url = ''
+# Apply S3 put notifications as deltas against the stored per-customer state
+# and publish only the customers they changed, instead of recomputing the day
+incrementalMode = False
+# Keeps parsed inputs as Arrow files keyed by ETag in /tmp, so a rerun over
+# unchanged objects skips downloading and parsing them; needs pyarrow
+parsedCacheEnabled = is_available('pyarrow')
+# Also copies the parsed files to S3 under parsed-cache/ for cold containers
+parsedCacheInS3 = False
+# The python engine looks customers up in a compact index saved in /tmp by
+# ETag instead of a dict built from the CSV; for a large customers file
+# against few orders a day (see reference_index.py)
+referenceIndexEnabled = False
+# Also copies the indexes to S3 under reference-index/ for cold containers
+referenceIndexInS3 = False
+# Splits a full day by customer_reference across this many worker invocations
+# of this function; 1 processes the day in a single invocation
+shardCount = 1
+# Saves publish progress in the state store, so a run that is retried after
+# timing out resumes where the last one stopped instead of resending the day
+publishCheckpoint = False
+stateStoreType = 'local'
 
+# State store settings by stateStoreType
+stateStoreConfig = {
+    'local': {
+        'path': '/tmp/summary_state.db',
+    },
+    'dynamodb': {
+        'table_name': '',
+    },
+}
 
-def amqpSender(status, message):
-    user = ""
-    password = ""
-    host = ""
-    port = ""
-    virtual_host = ""
+# RabbitMQ settings
+AMQP_USER = ""
+AMQP_PASS = ""
+AMQP_HOST = ""
+AMQP_PORT = ""
+AMQP_VIRTUAL_HOST = ""
 
-    # Connect to RabbitMQ
-    credentials = pika.PlainCredentials(user, password)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host, port, virtual_host, credentials))
+# MQTT settings
+MQTT_BROKER_HOST = "mqtt.example.com"
+MQTT_BROKER_PORT = 1883
+# Prefix of the client id; each container adds a random suffix
+MQTT_CLIENT_ID = "csv_processor"
+MQTT_USER = ""
+MQTT_PASS = ""
+MQTT_TOPIC_CUSTOMER_MESSAGES = "customer_messages"
+MQTT_TOPIC_ERROR_MESSAGES = "error_messages"
 
-    channel = connection.channel()
+# Publisher settings by messageQueueType; publishers and their connections
+# are created on first use and reused by warm invocations
+publisherConfig = {
+    'sqs': {
+        'queue_url': queue_url,
+    },
+    'amqp': {
+        'host': AMQP_HOST,
+        'port': AMQP_PORT,
+        'virtual_host': AMQP_VIRTUAL_HOST,
+        'user': AMQP_USER,
+        'password': AMQP_PASS,
+    },
+    'mqtt': {
+        'host': MQTT_BROKER_HOST,
+        'port': MQTT_BROKER_PORT,
+        'client_id': MQTT_CLIENT_ID,
+        'user': MQTT_USER,
+        'password': MQTT_PASS,
+        'topic': MQTT_TOPIC_CUSTOMER_MESSAGES,
+        'error_topic': MQTT_TOPIC_ERROR_MESSAGES,
+    },
+}
 
-    # Declare a queue
-    channel.queue_declare(queue='data_queue')
-    if status == 1:
-        channel.basic_publish(
-            exchange='', routing_key='data_queue', body=json.dumps(message))
-    else:
-        channel.basic_publish(
-            exchange='', routing_key='data_queue_error', body=json.dumps(message))
-
-
-def mqttSender(status, record):
-    # Define MQTT settings
-    MQTT_BROKER_HOST = "mqtt.example.com"
-    MQTT_BROKER_PORT = 1883
-    MQTT_CLIENT_ID = "csv_processor"
-    MQTT_USER = ""
-    MQTT_PASS = ""
-    MQTT_TOPIC_CUSTOMER_MESSAGES = "customer_messages"
-    MQTT_TOPIC_ERROR_MESSAGES = "error_messages"
-
-    # Create MQTT client instance
-    mqtt_client = mqtt.Client(MQTT_CLIENT_ID)
-    mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)
-    mqtt_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
-    if status == 1:
-        mqtt_client.publish(MQTT_TOPIC_CUSTOMER_MESSAGES, json.dumps(record))
-        time.sleep(0.1)
-    else:
-        mqtt_client.publish(MQTT_TOPIC_ERROR_MESSAGES, json.dumps(record))
-        time.sleep(0.1)
-
-
-def sqsSender(status, messageSQS):
-    # Publish results to Amazon SQS
-    sqs = boto3.resource('sqs')
-    queue_url = ''
-
-    if status == 1:
-        sqs_message = {
-            'Id': str(messageSQS['customer_reference']),
-            'MessageBody': json.dumps(messageSQS)
-        }
-        sqs_response = sqs.meta.client.send_message(
-            QueueUrl=queue_url, MessageBody=json.dumps(sqs_message))
-    else:
-        sqs_message = {
-            'Id': str(messageSQS['order_reference']),
-            'MessageBody': json.dumps(messageSQS)
-        }
-        sqs_response = sqs.meta.client.send_message(
-            QueueUrl=queue_url, MessageBody=json.dumps(sqs_message))
-
-
-def read_csv_from_s3(s3, bucket, key):
-    try:
-        response = s3.get_object(Bucket=bucket, Key=key)
-        content = StringIO(response['Body'].read().decode('utf-8'))
-        reader = csv.DictReader(content)
-        return [row for row in reader]
-    except Exception as e:
-        logger.error(f"Error while reading CSV '{key}' from bucket '{bucket}': {e}")
-        return None
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+# Clients, the selected publisher and a fixed engine are created during init
+# and reused by warm invocations. Only the backends the configuration selects
+# import their libraries.
+bucketName = 'mete-bucket-55'
+s3 = boto3.client('s3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+publisher = get_publisher(messageQueueType, **publisherConfig[messageQueueType])
+if packFormat:
+    publisher = PackingPublisher(publisher, packFormat)
+if processingEngine != 'auto':
+    get_engine(processingEngine)
+# Synchronous worker invocations can run up to the Lambda timeout
+lambdaClient = boto3.client('lambda', config=Config(read_timeout=900, max_pool_connections=max(shardCount, 10))) \
+    if shardCount > 1 else None
+# Loaded customers tables, revalidated with a conditional GET per invocation
+customerCache = DimensionCache()
+stateStore = get_state_store(stateStoreType, **stateStoreConfig[stateStoreType]) \
+    if incrementalMode or publishCheckpoint else None
+
+record_init(_init_started)
+
+
+def reference_indexes():
+    return get_reference_index_cache(s3=s3 if referenceIndexInS3 else None, bucket=bucketName)
+
+
+def open_and_load(load, key):
+    return load_and_close(load, open_s3_object(s3, bucketName, key)[0])
+
+
+def open_and_load_customers(engine, customer_file):
+    # The conditional GET of the customer cache, then the cached or loaded table
+    customers = customerCache.open(s3, bucketName, customer_file)
+    loader = partial(reference_indexes().load, 'customers', customers[2]) \
+        if referenceIndexEnabled and engine.name == 'python' else None
+    return s3_load(customerCache, engine, 'customers', s3, bucketName, customer_file, customers, loader)()
+
+
+def summarize_day(file_date):
+    customer_file = f"customers_{file_date}{inputSuffix}"
+    orders_file = f"orders_{file_date}{inputSuffix}"
+    items_file = f"items_{file_date}{inputSuffix}"
+
+    metrics = InvocationMetrics(messageQueueType=messageQueueType, fileDate=file_date)
+
+    # The engine is picked from the sizes that three HEAD requests report, so
+    # each file is then downloaded and parsed on its own thread as soon as
+    # its GET returns: 'download' covers the HEADs, 'parse' the GETs, any
+    # multipart spooling and the parsing itself.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        with metrics.stage('download'):
+            heads = list(executor.map(
+                lambda key: s3.head_object(Bucket=bucketName, Key=key), (customer_file, orders_file, items_file)))
+        sizes = [decompressed_size(key, head['ContentLength'], head.get('ContentEncoding'), head.get('Metadata'))
+                 for key, head in zip((customer_file, orders_file, items_file), heads)]
+        engine = get_engine(processingEngine, sum(sizes))
+        metrics.properties['engine'] = engine.name
+        if parsedCacheEnabled:
+            # Objects missing from the parsed cache are downloaded during 'parse'
+            cache = get_parsed_cache(s3=s3 if parsedCacheInS3 else None, bucket=bucketName)
+            loads = s3_loads(cache, engine, s3, bucketName, dict(zip(
+                ('customers', 'orders', 'items'), zip((customer_file, orders_file, items_file), heads))))
+            if referenceIndexEnabled and engine.name == 'python':
+                loads[0] = partial(reference_indexes().load, 'customers', heads[0]['ETag'],
+                                   lambda: open_s3_object(s3, bucketName, customer_file,
+                                                          IfMatch=heads[0]['ETag'])[0])
+            loads[0] = partial(customerCache.load, engine, bucketName, customer_file,
+                               heads[0]['ETag'], sizes[0], loads[0])
+        else:
+            loads = [partial(open_and_load_customers, engine, customer_file),
+                     partial(open_and_load, engine.load_orders, orders_file),
+                     partial(open_and_load, engine.load_items, items_file)]
+        customer_messages, all_error_messages = summarize_loads(engine, loads, executor=executor, metrics=metrics)
+    return customer_messages, all_error_messages, metrics
+
+
+def summarize_day_sharded(file_date, context):
+    customer_file = f"customers_{file_date}{inputSuffix}"
+    orders_file = f"orders_{file_date}{inputSuffix}"
+    items_file = f"items_{file_date}{inputSuffix}"
+
+    metrics = InvocationMetrics(messageQueueType=messageQueueType, fileDate=file_date, shards=shardCount)
+
+    with ThreadPoolExecutor(max_workers=S3_MAX_POOL_CONNECTIONS) as executor, \
+            ThreadPoolExecutor(max_workers=shardCount) as workers:
+        with metrics.stage('download'):
+            objects = list(executor.map(
+                lambda key: open_s3_object(s3, bucketName, key), (customer_file, orders_file, items_file)))
+        # Each run has its own folder, so coordinators of the same day (e.g. a
+        # retry of a timed-out run) never read each other's shards
+        prefix = f"{SHARD_PREFIX}{file_date}/{context.aws_request_id}/"
+        try:
+            with tempfile.TemporaryDirectory() as work_dir:
+                with metrics.stage('split'):
+                    shard_dirs, orphan_errors = split(*(stream for stream, _ in objects), shardCount, work_dir)
+                    prefixes = upload_shards(s3, bucketName, prefix, shard_dirs, executor)
+            with metrics.stage('shards'):
+                partial_keys = invoke_workers(lambdaClient, context.function_name, bucketName, prefixes, workers)
+            with metrics.stage('reduce') as reduce_stage:
+                customer_messages, all_error_messages = merge(
+                    read_partials(s3, bucketName, partial_keys, executor), orphan_errors)
+                reduce_stage.rows = len(customer_messages) + len(all_error_messages)
+        finally:
+            delete_shards(s3, bucketName, prefix)
+    return customer_messages, all_error_messages, metrics
+
+
+def publish_summary(metrics, customer_messages, all_error_messages, file_date, event):
+    if verboseLogging:
+        print(json.dumps(customer_messages, indent=2))
+        print(json.dumps(all_error_messages, indent=2))
+
+    with metrics.stage('publish') as publish:
+        # {"resetPublishCheckpoint": true} in the event publishes the day again
+        # from the start, e.g. to re-send it on purpose
+        reset = bool((event or {}).get('resetPublishCheckpoint'))
+        checkpoint = PublishCheckpoint(stateStore, file_date, reset=reset) if publishCheckpoint else None
+        publish.rows = publish_messages(publisher, customer_messages, all_error_messages, checkpoint=checkpoint)
+
 
 def lambda_handler(event, context):
     # Outputs the incoming event into CW logs
     logger.info("Event:")
     logger.info(event)
 
+    if event and 'shard' in event:
+        # Worker invocation from a sharded coordinator; it only summarizes
+        shard = event['shard']
+        return {'partial': summarize_s3_shard(s3, shard['bucket'], shard['prefix'], processingEngine)}
+    if is_internal_upload(event, (SHARD_PREFIX, PARSED_CACHE_PREFIX, REFERENCE_INDEX_PREFIX)):
+        return {"statusCode": 200, "sqsSend": False}
+
     file_date = datetime.datetime.now().strftime("%d%m%Y")
+    deltas = parse_s3_event(event) if incrementalMode else []
+    if incrementalMode and not deltas and is_s3_event(event):
+        # e.g. a removal or an upload that is not a customers_/orders_/items_
+        # file; only other triggers, such as a schedule, run the whole day
+        logger.info("No deltas in the S3 event, nothing to publish")
+        return {"statusCode": 200, "sqsSend": False}
+    if deltas:
+        # Events of one date are applied, published and confirmed one at a
+        # time, so concurrent uploads cannot overwrite each other's state
+        with locked(stateStore, deltas):
+            metrics = InvocationMetrics(messageQueueType=messageQueueType, mode='incremental')
+            with metrics.stage('summarize') as summarize:
+                customer_messages, all_error_messages = process_event(s3, stateStore, deltas)
+                summarize.rows = len(customer_messages) + len(all_error_messages)
+            publish_summary(metrics, customer_messages, all_error_messages, file_date, event)
+            # Only now may a retry of this event skip the deltas
+            confirm_published(stateStore, deltas)
+    else:
+        if shardCount > 1:
+            customer_messages, all_error_messages, metrics = summarize_day_sharded(file_date, context)
+        else:
+            customer_messages, all_error_messages, metrics = summarize_day(file_date)
+        publish_summary(metrics, customer_messages, all_error_messages, file_date, event)
 
-    customer_file = f"customers_{file_date}.csv"
-    orders_file = f"orders_{file_date}.csv"
-    items_file = f"items_{file_date}.csv"
-    s3 = boto3.client('s3')
-    bucketName = 'mete-bucket-55'
-    customers = read_csv_from_s3(s3, bucketName, customer_file)
-    orders = read_csv_from_s3(s3, bucketName, orders_file)
-    items = read_csv_from_s3(s3, bucketName, items_file)
-    
-    customer_dict = {c["customer_reference"]: c for c in customers}
-    order_dict = {o["order_reference"]: o for o in orders}
-    order_item_dict = defaultdict(list)
-
-    for item in items:
-        order_item_dict[item["order_reference"]].append(item)
-
-    missing_customer_errors = []
-    for order in orders:
-        if order["customer_reference"] not in customer_dict:
-            error_message = {
-                "type": "error_message",
-                "customer_reference": order["customer_reference"],
-                "order_reference": order["order_reference"],
-                "message": "Customer reference not found in customers."
-            }
-            missing_customer_errors.append(error_message)
-
-    missing_order_errors = []
-    for item in items:
-        if item["order_reference"] not in order_dict:
-            error_message = {
-                "type": "error_message",
-                "customer_reference": None,
-                "order_reference": item["order_reference"],
-                "message": "Order reference not found in orders."
-            }
-            missing_order_errors.append(error_message)
-
-    all_error_messages = missing_customer_errors + missing_order_errors
-
-    customer_summary = defaultdict(lambda: {'orders': 0, 'total_price': 0})
-
-    for order in orders:
-        customer_ref = order["customer_reference"]
-        if customer_ref in customer_dict:
-            customer_summary[customer_ref]['orders'] += 1
-            for item in order_item_dict[order["order_reference"]]:
-                customer_summary[customer_ref]['total_price'] += float(
-                    item["total_price"])
-
-    customer_messages = [{
-        "type": "customer_message",
-        "customer_reference": k,
-        "orders": v["orders"],
-        "total_price": v["total_price"]
-    } for k, v in customer_summary.items()]
-
-    print(json.dumps(customer_messages, indent=2))
-    print(json.dumps(all_error_messages, indent=2))
-
-    # Send customer messages
-    for message in customer_messages:
-        if messageQueueType == 'sqs':
-            sqsSender(1, message)
-        elif messageQueueType == 'amqp':
-            amqpSender(1, message)
-        elif messageQueueType == 'mqtt':
-            mqttSender(1, message)
-    # Send error messages
-    for message in all_error_messages:
-        if messageQueueType == 'sqs':
-            sqsSender(0, message)
-        elif messageQueueType == 'amqp':
-            amqpSender(0, message)
-        elif messageQueueType == 'mqtt':
-            mqttSender(0, message)
+    metrics.count('CustomerMessages', len(customer_messages))
+    metrics.count('ErrorMessages', len(all_error_messages))
+    metrics.emit(getattr(context, 'function_name', None))
+    log_import_report()
 
     return {
         "statusCode": 200,
@@ -0,0 +1,108 @@
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = 'CustomerOrderSummary'
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    # Resident set size right now, or None where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class Stage:
+    __slots__ = ('name', 'seconds', 'rows', 'rss_delta_mb')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.rows = None
+        self.rss_delta_mb = None
+
+
+class InvocationMetrics:
+    """Collects per-stage wall time, rows/s and RSS growth for one invocation.
+
+    ``emit`` writes everything as a single CloudWatch Embedded Metric Format
+    record on stdout, which the Lambda log pipeline turns into metrics.
+    A stage's RSS delta is the resident memory it left behind, negative if
+    it freed more than it kept. Memory a stage allocated and freed again
+    shows only in PeakRSS, the high-water mark of the whole process.
+    """
+
+    def __init__(self, namespace=METRICS_NAMESPACE, **properties):
+        self.namespace = namespace
+        self.properties = properties
+        self.stages = []
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        stage = Stage(name)
+        rss_before = current_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.perf_counter() - start
+            rss_after = current_rss_mb()
+            if rss_before is not None and rss_after is not None:
+                stage.rss_delta_mb = rss_after - rss_before
+            self.stages.append(stage)
+
+    def count(self, name, value):
+        self.counts[name] = value
+
+    def to_emf(self, function_name=None):
+        metrics = []
+        values = {}
+
+        def put(name, value, unit):
+            metrics.append({'Name': name, 'Unit': unit})
+            values[name] = value
+
+        for stage in self.stages:
+            prefix = stage.name.capitalize()
+            put(f'{prefix}Time', round(stage.seconds * 1000, 3), 'Milliseconds')
+            if stage.rss_delta_mb is not None:
+                put(f'{prefix}RSSDelta', round(stage.rss_delta_mb, 1), 'Megabytes')
+            if stage.rows is not None:
+                put(f'{prefix}Rows', stage.rows, 'Count')
+                if stage.seconds > 0:
+                    put(f'{prefix}RowsPerSecond', round(stage.rows / stage.seconds), 'Count/Second')
+        for name, value in self.counts.items():
+            put(name, value, 'Count')
+        put('PeakRSS', round(peak_rss_mb(), 1), 'Megabytes')
+
+        dimensions = {'FunctionName': function_name or 'local'}
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': metrics,
+                }],
+            },
+        }
+        record.update(dimensions)
+        record.update(self.properties)
+        record.update(values)
+        return record
+
+    def emit(self, function_name=None):
+        print(json.dumps(self.to_emf(function_name)))
@@ -0,0 +1,83 @@
+import base64
+import io
+import json
+
+from import_timer import timed_import
+from serialization import get_json_encoder
+
+# Packed publishing sends many records per queue message. A frame is the
+# concatenation of encoded records and travels with its content type, so a
+# consumer can tell frames from single JSON messages and unpack either:
+#
+#   application/x-ndjson  one compact JSON record per line
+#   application/msgpack   msgpack records back to back; needs msgpack
+#
+# Transports that only carry text (SQS) base64-encode msgpack frames and say
+# so with a content encoding of 'base64'.
+NDJSON = 'application/x-ndjson'
+MSGPACK = 'application/msgpack'
+
+# Frame limits; 64 KB is the unit SQS bills a request by
+PACK_MAX_RECORDS = 500
+PACK_MAX_BYTES = 64 * 1024
+
+
+class NdjsonCodec:
+    content_type = NDJSON
+
+    def __init__(self):
+        self.json = get_json_encoder()
+
+    def encode(self, record):
+        return self.json.encode(record) + b'\n'
+
+    def encode_many(self, records):
+        return [body + b'\n' for body in self.json.encode_many(records)]
+
+    def decode(self, frame):
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8')
+        return [json.loads(line) for line in frame.splitlines() if line.strip()]
+
+
+class MsgpackCodec:
+    content_type = MSGPACK
+
+    def __init__(self):
+        self.msgpack = timed_import('msgpack')
+
+    def encode(self, record):
+        return self.msgpack.packb(record, use_bin_type=True)
+
+    def encode_many(self, records):
+        packb = self.msgpack.packb
+        return [packb(record, use_bin_type=True) for record in records]
+
+    def decode(self, frame):
+        return list(self.msgpack.Unpacker(io.BytesIO(frame), raw=False))
+
+
+PACK_FORMATS = {'ndjson': NdjsonCodec, 'msgpack': MsgpackCodec}
+_CONTENT_TYPES = {NdjsonCodec.content_type: 'ndjson', MsgpackCodec.content_type: 'msgpack'}
+_codecs = {}
+
+
+def get_codec(format):
+    if format not in _codecs:
+        if format not in PACK_FORMATS:
+            raise ValueError(f"Unknown pack format '{format}', expected one of {sorted(PACK_FORMATS)}")
+        _codecs[format] = PACK_FORMATS[format]()
+    return _codecs[format]
+
+
+def unpack(body, content_type=None, content_encoding=None):
+    """Returns the records in a message body.
+
+    Bodies without a packed content type are single JSON messages, as sent
+    without packing.
+    """
+    if content_encoding == 'base64':
+        body = base64.b64decode(body)
+    if content_type in _CONTENT_TYPES:
+        return get_codec(_CONTENT_TYPES[content_type]).decode(body)
+    return [json.loads(body)]
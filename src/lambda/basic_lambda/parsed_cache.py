@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+from functools import partial
+
+from botocore.exceptions import ClientError
+
+from import_timer import timed_import
+from s3_csv import open_s3_object
+
+logger = logging.getLogger()
+
+# Parsed inputs are kept as Arrow IPC files named after the input kind and
+# the S3 ETag of the CSV they came from. An unchanged object is then read
+# back memory-mapped instead of being downloaded and parsed again, e.g. when
+# a day is reprocessed after a publish failure or with another publisher.
+# The files hold only the columns the summary uses, with the same types for
+# every engine, so a table cached by one engine can be used by the others.
+#
+# /tmp survives between warm invocations of a container; with a bucket the
+# files are also copied to S3 so cold containers can use them.
+PARSED_CACHE_DIR = '/tmp/parsed-cache'
+PARSED_CACHE_PREFIX = 'parsed-cache/'
+# Least recently used files are removed beyond this size; /tmp is 512 MB by default
+PARSED_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+_cache = {}
+
+
+class FileCache:
+    """Files named after an input kind and ETag in a local directory, copied
+    to S3 when given a bucket. Least recently used files are removed beyond
+    max_bytes."""
+
+    suffix = ''
+
+    def __init__(self, directory, max_bytes, s3=None, bucket=None, prefix=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _name(self, kind, etag):
+        etag = etag.strip('"')
+        return f"{kind}-{etag}{self.suffix}"
+
+    def path(self, kind, etag):
+        # Local path of the cached file, downloaded first if only S3 has it;
+        # None on a miss
+        name = self._name(kind, etag)
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path) and not self._download(name, path):
+            return None
+        # The modification time orders the files for eviction
+        os.utime(path)
+        return path
+
+    def store(self, kind, etag, write):
+        # write(path) writes the file; it is written next to the target and
+        # renamed, so readers never see half a file
+        name = self._name(kind, etag)
+        path = os.path.join(self.directory, name)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        write(temporary)
+        os.replace(temporary, path)
+        if self.s3 is not None:
+            self.s3.upload_file(path, self.bucket, self.prefix + name)
+        self._evict()
+
+    def _download(self, name, path):
+        if self.s3 is None:
+            return False
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            self.s3.download_file(self.bucket, self.prefix + name, temporary)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        os.replace(temporary, path)
+        return True
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.suffix):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # Files already opened or mapped by a reader stay valid after the unlink
+                os.remove(path)
+                total -= size
+
+
+class ParsedCache(FileCache):
+    """Arrow IPC cache of parsed inputs; needs pyarrow."""
+
+    suffix = '.arrow'
+
+    def __init__(self, directory=PARSED_CACHE_DIR, max_bytes=PARSED_CACHE_MAX_BYTES,
+                 s3=None, bucket=None, prefix=PARSED_CACHE_PREFIX):
+        self.pa = timed_import('pyarrow')
+        self.ipc = timed_import('pyarrow.ipc')
+        super().__init__(directory, max_bytes, s3, bucket, prefix)
+        self.schemas = {
+            'customers': self.pa.schema([('customer_reference', self.pa.string())]),
+            'orders': self.pa.schema([('customer_reference', self.pa.string()),
+                                      ('order_reference', self.pa.string())]),
+            'items': self.pa.schema([('order_reference', self.pa.string()),
+                                     ('total_price', self.pa.float64())]),
+        }
+
+    def get(self, kind, etag):
+        path = self.path(kind, etag)
+        if path is None:
+            return None
+        return self.ipc.open_file(self.pa.memory_map(path)).read_all()
+
+    def put(self, kind, etag, table):
+        def write(path):
+            with self.pa.OSFile(path, 'wb') as sink, self.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+        self.store(kind, etag, write)
+
+    def load(self, engine, kind, etag, open_stream):
+        """Returns the engine's table for one input, parsing it only on a miss.
+
+        ``open_stream`` is called on a miss and must return a binary stream
+        of exactly the object version ``etag`` names.
+        """
+        table = self.get(kind, etag) if engine.in_memory else None
+        if table is not None:
+            logger.info(f"Parsed {kind} {etag} loaded from the cache")
+            return engine.from_arrow(kind, table)
+
+        stream = open_stream()
+        try:
+            loaded = getattr(engine, f'load_{kind}')(stream)
+        finally:
+            stream.close()
+        if not engine.in_memory:
+            return loaded
+        try:
+            self.put(kind, etag, engine.to_arrow(kind, loaded, self.schemas[kind]))
+        except (OSError, ClientError) as error:
+            # A cache that cannot be written must not fail the run
+            logger.warning(f"Could not cache parsed {kind} {etag}: {error!r}")
+        return loaded
+
+
+def get_parsed_cache(**config):
+    # Created on first use so pyarrow is imported only when the cache is used
+    if 'cache' not in _cache:
+        _cache['cache'] = ParsedCache(**config)
+    return _cache['cache']
+
+
+def s3_loads(cache, engine, s3, bucket, heads):
+    # One load callable per input for engines.summarize_loads. heads maps
+    # kind -> (key, head_object response); IfMatch makes sure the GET on a
+    # miss returns the version whose ETag the parsed table is filed under.
+    def load(kind, key, etag):
+        return cache.load(engine, kind, etag,
+                          lambda: open_s3_object(s3, bucket, key, IfMatch=etag)[0])
+
+    return [partial(load, kind, key, head['ETag']) for kind, (key, head) in heads.items()]
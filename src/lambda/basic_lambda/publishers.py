@@ -0,0 +1,678 @@
+import base64
+import hashlib
+import logging
+import queue as queue_module
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import boto3
+
+from import_timer import timed_import
+from packing import NDJSON, PACK_MAX_BYTES, PACK_MAX_RECORDS, get_codec
+from serialization import get_json_encoder
+
+logger = logging.getLogger()
+
+# pika and paho-mqtt are only imported by the backend that uses them, so the
+# SQS configuration never pays for them at init
+
+# Message kinds passed to Publisher.send
+CUSTOMER_MESSAGE = 1
+ERROR_MESSAGE = 0
+
+# Number of sends the PublishEngine keeps in flight
+PUBLISH_CONCURRENCY = 10
+# Most messages handed to one send_encoded call by PublishEngine.submit_many
+PUBLISH_CHUNK_SIZE = 100
+
+# SendMessageBatch limits
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+SQS_MAX_RETRIES = 3
+# FIFO MessageGroupId / MessageDeduplicationId: up to 128 printable ASCII
+# characters without spaces
+SQS_FIFO_ID = re.compile(r'[!-~]{1,128}')
+
+# Broker connections are kept open across messages and warm invocations
+BROKER_HEARTBEAT = 60
+MQTT_MAX_INFLIGHT = 100
+MQTT_CONNECT_TIMEOUT = 10
+
+# Created once per container and reused by warm invocations
+_sqs_client = None
+
+PUBLISHERS = {}
+_publisher_instances = {}
+
+
+class PublishError(Exception):
+    """Raised by ``flush`` for messages the broker did not accept."""
+
+
+def register_publisher(name):
+    def decorator(cls):
+        PUBLISHERS[name] = cls
+        return cls
+    return decorator
+
+
+def get_publisher(name, **config):
+    # Publishers hold clients and broker connections, so one instance per
+    # name is kept for the lifetime of the container
+    if name not in _publisher_instances:
+        if name not in PUBLISHERS:
+            raise ValueError(f"Unknown publisher '{name}', expected one of {sorted(PUBLISHERS)}")
+        _publisher_instances[name] = PUBLISHERS[name](**config)
+    return _publisher_instances[name]
+
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        _sqs_client = boto3.client('sqs')
+    return _sqs_client
+
+
+class Publisher:
+    """Interface shared by the message queue backends.
+
+    ``encode`` turns a list of messages into their bodies, one per message;
+    ``send_encoded`` sends messages with the bodies ``encode`` returned for
+    them and may be called from several PublishEngine threads at once.
+    Backends that deduplicate take the optional per-message ``dedup_ids``.
+    ``flush`` is called once after the last send of an invocation and must
+    return only when everything sent so far has been handed to the broker;
+    it raises PublishError if the broker rejected any of it.
+    ``destination`` names the backend and where it sends to, e.g. to keep
+    the publish progress of each destination apart.
+    """
+
+    destination = None
+
+    def __init__(self):
+        # Resolved here, on the thread that builds the publisher, so the
+        # PublishEngine threads never import an encoder
+        self.json = get_json_encoder()
+
+    def encode(self, messages):
+        return self.json.encode_many(messages)
+
+    def send(self, status, message):
+        self.send_encoded(status, [message], self.encode([message]))
+
+    def send_encoded(self, status, messages, bodies, dedup_ids=None):
+        raise NotImplementedError
+
+    def send_frame(self, status, body, content_type):
+        # Sends one packed frame (bytes) of records; see PackingPublisher
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class PublishEngine:
+    """Runs Publisher sends on a thread pool with a bounded number of sends in flight.
+
+    ``submit`` sends one message, ``submit_many`` a list of messages encoded
+    in bulk. Both block once ``max_in_flight`` sends are pending, so producers
+    cannot queue up unbounded work. ``wait`` waits for the pending sends and
+    flushes the publisher, ``close`` also shuts the pool down; both re-raise
+    the first send error.
+    """
+
+    def __init__(self, publisher, max_in_flight=PUBLISH_CONCURRENCY):
+        self.publisher = publisher
+        self.max_in_flight = max_in_flight
+        self.submitted = 0
+        self.errors = 0
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._first_error = None
+
+    def submit(self, status, message):
+        self._submit(self.publisher.send, status, message)
+        self.submitted += 1
+
+    def submit_many(self, status, messages, bodies=None, dedup_ids=None):
+        # Encodes all messages on this thread, unless their
+        # bodies are given, then sends them in chunks spread over the senders
+        if bodies is None:
+            bodies = self.publisher.encode(messages)
+        chunk_size = max(1, min(PUBLISH_CHUNK_SIZE, -(-len(messages) // self.max_in_flight)))
+        for start in range(0, len(messages), chunk_size):
+            end = start + chunk_size
+            self._submit(self.publisher.send_encoded, status, messages[start:end], bodies[start:end],
+                         dedup_ids[start:end] if dedup_ids is not None else None)
+        self.submitted += len(messages)
+
+    def _submit(self, send, *args):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(send, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+        self._slots.release()
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Publish failed: {error!r}")
+            self.errors += 1
+            if self._first_error is None:
+                self._first_error = error
+
+    def wait(self):
+        # Returns once everything submitted so far has been handed to the
+        # broker. The errors are read from the futures themselves, since
+        # wait() can return before their done callbacks have run.
+        with self._pending_lock:
+            futures = list(self._pending)
+        wait(futures)
+        for future in futures:
+            error = future.exception()
+            if error is not None and self._first_error is None:
+                self._first_error = error
+        self.publisher.flush()
+        if self._first_error is not None:
+            raise self._first_error
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.publisher.flush()
+        if self._first_error is not None:
+            raise self._first_error
+
+
+def publish_messages(publisher, customer_messages, error_messages, max_in_flight=PUBLISH_CONCURRENCY,
+                     checkpoint=None):
+    # Publishes a day's messages and flushes the publisher; returns the
+    # number of messages sent. With a PublishCheckpoint (checkpoint.py) the
+    # messages go out in windows, the progress is saved after each window,
+    # and the windows a previous run already sent are skipped.
+    publish_engine = PublishEngine(publisher, max_in_flight=max_in_flight)
+    try:
+        if checkpoint is None:
+            publish_engine.submit_many(CUSTOMER_MESSAGE, customer_messages)
+            publish_engine.submit_many(ERROR_MESSAGE, error_messages)
+        else:
+            kinds = ((CUSTOMER_MESSAGE, customer_messages), (ERROR_MESSAGE, error_messages))
+            encoded = {status: publisher.encode(messages) for status, messages in kinds}
+            checkpoint.begin(encoded, publisher.destination)
+            for status, messages in kinds:
+                bodies = encoded[status]
+                dedup_ids = checkpoint.dedup_ids(status, messages)
+                for start in range(checkpoint.sent(status), len(messages), checkpoint.every):
+                    end = min(start + checkpoint.every, len(messages))
+                    publish_engine.submit_many(status, messages[start:end], bodies[start:end], dedup_ids[start:end])
+                    publish_engine.wait()
+                    checkpoint.save(status, end)
+    finally:
+        publish_engine.close()
+    return publish_engine.submitted
+
+
+@register_publisher('sqs')
+class SqsBatchPublisher(Publisher):
+    """Buffers messages into SendMessageBatch calls of up to 10 entries / 256 KB.
+
+    Entries SQS reports as failed are retried on their own with backoff.
+    Sender faults and entries still failing after ``max_retries`` are kept
+    in ``failed`` until the next ``flush``, which raises for them. Full batches
+    are sent by the thread that filled them, so several batches can be in
+    flight at once under a PublishEngine.
+
+    FIFO queues (``.fifo`` URLs) get each message's reference as its
+    MessageGroupId and its dedup id as MessageDeduplicationId. Without dedup
+    ids, the digest of the body is used, numbered from its second copy on
+    until the ``flush`` that ends the run, so identical messages, such as
+    the same error for two items, are not dropped as duplicates of each other.
+    """
+
+    def __init__(self, queue_url, client=None, max_retries=SQS_MAX_RETRIES):
+        super().__init__()
+        self.queue_url = queue_url
+        self.client = client or get_sqs_client()
+        self.max_retries = max_retries
+        self.fifo = queue_url.endswith('.fifo')
+        self.destination = f"sqs:{queue_url}"
+        self.sent = 0
+        self.failed = []
+        self._entries = []
+        self._bytes = 0
+        self._copies = {}
+        self._lock = threading.Lock()
+
+    def send_encoded(self, status, messages, bodies, dedup_ids=None):
+        key = 'customer_reference' if status == CUSTOMER_MESSAGE else 'order_reference'
+        for n, (message, body) in enumerate(zip(messages, bodies)):
+            self.add_body(message[key], body, dedup_id=dedup_ids[n] if dedup_ids is not None else None)
+
+    def send_frame(self, status, body, content_type):
+        attributes = {'ContentType': {'DataType': 'String', 'StringValue': content_type}}
+        if content_type != NDJSON:
+            # Message bodies must be text
+            body = base64.b64encode(body).decode('ascii')
+            attributes['ContentEncoding'] = {'DataType': 'String', 'StringValue': 'base64'}
+        # Frames are named by their contents, so FIFO queues spread them over
+        # groups and drop a frame that a retry sends again
+        self.add_body(f"frame-{self._digest(body)[:16]}", body, attributes)
+
+    def add_body(self, message_id, body, attributes=None, dedup_id=None):
+        # body is the encoded message, as UTF-8 bytes or text
+        if isinstance(body, bytes):
+            size, body = len(body), body.decode('utf-8')
+        else:
+            size = len(body.encode('utf-8'))
+        entry = {'MessageBody': body}
+        if self.fifo:
+            entry['MessageGroupId'] = self._fifo_id(str(message_id))
+            entry['MessageDeduplicationId'] = self._fifo_id(dedup_id) if dedup_id else self._copy_id(body)
+        if attributes:
+            # Attribute names, types and values count towards the size limits
+            size += sum(len(name) + len(value['DataType']) + len(value['StringValue'].encode('utf-8'))
+                        for name, value in attributes.items())
+            entry['MessageAttributes'] = attributes
+        if size > SQS_MAX_BATCH_BYTES:
+            logger.error(f"Message '{message_id}' is {size} bytes, over the SQS limit")
+            with self._lock:
+                self.failed.append({'Id': str(message_id), 'Code': 'MessageTooLong', 'SenderFault': True})
+            return
+
+        full_batch = None
+        with self._lock:
+            if len(self._entries) == SQS_MAX_BATCH_ENTRIES or self._bytes + size > SQS_MAX_BATCH_BYTES:
+                full_batch = self._take_batch()
+            entry['Id'] = self._entry_id(message_id)
+            self._entries.append(entry)
+            self._bytes += size
+
+        if full_batch:
+            self._send_batch(full_batch)
+
+    def flush(self):
+        with self._lock:
+            entries = self._take_batch()
+        if entries:
+            self._send_batch(entries)
+        with self._lock:
+            failed, self.failed = self.failed, []
+            self._copies = {}
+        if failed:
+            raise PublishError(f"SQS rejected {len(failed)} message(s), first '{failed[0]['Id']}': "
+                               f"{failed[0].get('Code')} {failed[0].get('Message', '')}")
+
+    def _take_batch(self):
+        entries, self._entries, self._bytes = self._entries, [], 0
+        return entries
+
+    def _send_batch(self, entries):
+        attempt = 0
+        while entries:
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            with self._lock:
+                self.sent += len(response.get('Successful', []))
+
+            pending = {e['Id']: e for e in entries}
+            entries = []
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault') or attempt >= self.max_retries:
+                    logger.error(f"SQS rejected message '{failure['Id']}': "
+                                 f"{failure.get('Code')} {failure.get('Message', '')}")
+                    with self._lock:
+                        self.failed.append(failure)
+                else:
+                    entries.append(pending[failure['Id']])
+
+            if entries:
+                attempt += 1
+                time.sleep(0.1 * 2 ** attempt)
+
+    @staticmethod
+    def _digest(body):
+        return hashlib.sha256(body.encode('utf-8') if isinstance(body, str) else body).hexdigest()
+
+    def _copy_id(self, body):
+        # '<digest>' for the first copy of a body in this run, then '<digest>:<n>'
+        digest = self._digest(body)
+        with self._lock:
+            copy = self._copies.get(digest, 0)
+            self._copies[digest] = copy + 1
+        return f"{digest}:{copy}" if copy else digest
+
+    def _fifo_id(self, value):
+        # Ids SQS would reject are replaced by their digest
+        return value if SQS_FIFO_ID.fullmatch(value) else self._digest(value)
+
+    def _entry_id(self, message_id):
+        # Batch entry ids are limited to 80 alphanumeric, '-' or '_' characters
+        # and must be distinct within one batch
+        entry_id = re.sub(r'[^A-Za-z0-9_-]', '_', str(message_id))[:72] or 'msg'
+        if any(e['Id'] == entry_id for e in self._entries):
+            entry_id = f"{entry_id}-{len(self._entries)}"
+        return entry_id
+
+
+class AmqpConnectionManager:
+    """Keeps one RabbitMQ connection and channel open for the container.
+
+    Queues are declared once per channel and the connection is re-opened
+    when the broker drops it, e.g. after heartbeats were missed while the
+    container was frozen between invocations.
+    """
+
+    def __init__(self, host, port, virtual_host, user, password, heartbeat=BROKER_HEARTBEAT):
+        self.host = host
+        self.port = port
+        self.virtual_host = virtual_host
+        self.pika = timed_import('pika')
+        self.credentials = self.pika.PlainCredentials(user, password)
+        self.heartbeat = heartbeat
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+
+    def publish(self, routing_key, body, content_type=None):
+        try:
+            self._publish(routing_key, body, content_type)
+        except (self.pika.exceptions.AMQPConnectionError, self.pika.exceptions.AMQPChannelError) as e:
+            logger.warning(f"AMQP connection lost ({e!r}), reconnecting")
+            self.close()
+            self._publish(routing_key, body, content_type)
+
+    def _publish(self, routing_key, body, content_type=None):
+        channel = self._get_channel()
+        if routing_key not in self._declared:
+            channel.queue_declare(queue=routing_key)
+            self._declared.add(routing_key)
+        properties = self.pika.BasicProperties(content_type=content_type) if content_type else None
+        channel.basic_publish(exchange='', routing_key=routing_key, body=body, properties=properties)
+
+    def _get_channel(self):
+        if self._connection is None or self._connection.is_closed:
+            self._connection = self.pika.BlockingConnection(self.pika.ConnectionParameters(
+                self.host, self.port, self.virtual_host, self.credentials,
+                heartbeat=self.heartbeat))
+            self._channel = None
+        if self._channel is None or self._channel.is_closed:
+            self._channel = self._connection.channel()
+            self._declared = set()
+        return self._channel
+
+    def flush(self):
+        # Services heartbeats and pushes out anything still buffered
+        if self._connection is not None and self._connection.is_open:
+            self._connection.process_data_events(0)
+
+    def close(self):
+        if self._connection is not None and self._connection.is_open:
+            try:
+                self._connection.close()
+            except self.pika.exceptions.AMQPError:
+                pass
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+
+
+class MqttConnectionManager:
+    """Keeps one MQTT client connected for the container.
+
+    The paho network loop runs in the background and reconnects on its own.
+    ``client_id`` is a prefix: brokers drop the older of two sessions with
+    the same id, so every container and script gets its own, and a clean
+    session since nothing subscribes on it.
+    Instead of sleeping after every publish, at most ``max_inflight`` QoS 1
+    messages are left unacknowledged; beyond that ``publish`` waits for the
+    oldest PUBACKs to come back.
+    """
+
+    def __init__(self, host, port, client_id, user, password, qos=1,
+                 keepalive=BROKER_HEARTBEAT, max_inflight=MQTT_MAX_INFLIGHT):
+        self.host = host
+        self.port = port
+        # At most 23 characters for strict MQTT 3.1.1 brokers with the default prefix
+        self.client_id = f"{client_id}-{uuid.uuid4().hex[:8]}"
+        self.user = user
+        self.password = password
+        self.qos = qos
+        self.keepalive = keepalive
+        self.max_inflight = max_inflight
+        self.mqtt = timed_import('paho.mqtt.client')
+        self.failed = 0
+        self._client = None
+        self._connected = threading.Event()
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        client = self._get_client()
+        info = client.publish(topic, payload, qos=self.qos)
+        with self._lock:
+            self._pending.append(info)
+            backlog = len(self._pending)
+        if backlog >= self.max_inflight:
+            self._wait_for_acks(self.max_inflight // 2)
+
+    def flush(self):
+        # Raises for the messages that failed since the last flush
+        self._wait_for_acks(0)
+        with self._lock:
+            failed, self.failed = self.failed, 0
+        if failed:
+            raise PublishError(f"{failed} MQTT message(s) were not acknowledged")
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                client = self.mqtt.Client(self.client_id, clean_session=True)
+                client.username_pw_set(self.user, self.password)
+                client.max_inflight_messages_set(self.max_inflight)
+                client.reconnect_delay_set(min_delay=1, max_delay=30)
+                client.on_connect = self._on_connect
+                client.on_disconnect = self._on_disconnect
+                client.connect(self.host, self.port, keepalive=self.keepalive)
+                client.loop_start()
+                self._client = client
+        if not self._connected.wait(MQTT_CONNECT_TIMEOUT):
+            raise ConnectionError(f"MQTT broker {self.host}:{self.port} not reachable")
+        return self._client
+
+    def _wait_for_acks(self, keep):
+        while True:
+            with self._lock:
+                if len(self._pending) <= keep:
+                    return
+                info = self._pending.popleft()
+            try:
+                info.wait_for_publish(MQTT_CONNECT_TIMEOUT)
+            except (ValueError, RuntimeError) as e:
+                logger.error(f"MQTT publish {info.mid} failed: {e}")
+                with self._lock:
+                    self.failed += 1
+                continue
+            if not info.is_published():
+                logger.error(f"MQTT publish {info.mid} was not acknowledged")
+                with self._lock:
+                    self.failed += 1
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._connected.set()
+        else:
+            logger.error(f"MQTT connection refused: {self.mqtt.connack_string(rc)}")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        if rc != 0:
+            logger.warning(f"MQTT connection lost ({self.mqtt.error_string(rc)}), reconnecting")
+
+    def close(self):
+        if self._client is not None:
+            try:
+                self.flush()
+            finally:
+                self._client.loop_stop()
+                self._client.disconnect()
+                self._client = None
+                self._connected.clear()
+
+
+@register_publisher('amqp')
+class AmqpPublisher(Publisher):
+    """Publishes over a pool of AMQP connections, one per concurrent sender.
+
+    pika connections are not thread-safe, so each in-flight send borrows a
+    connection from the pool and returns it afterwards.
+    """
+
+    def __init__(self, host, port, virtual_host, user, password,
+                 queue='data_queue', error_queue='data_queue_error', pool_size=PUBLISH_CONCURRENCY):
+        super().__init__()
+        self.connection_args = (host, port, virtual_host, user, password)
+        self.queue = queue
+        self.error_queue = error_queue
+        self.destination = f"amqp:{host}:{port}{virtual_host}:{queue},{error_queue}"
+        self.pool_size = pool_size
+        self._pool = queue_module.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def send_encoded(self, status, messages, bodies, dedup_ids=None):
+        self._publish(status, bodies)
+
+    def send_frame(self, status, body, content_type):
+        # The frame format travels as the AMQP content_type property
+        self._publish(status, [body], content_type)
+
+    def _publish(self, status, bodies, content_type=None):
+        # All bodies go out over one borrowed connection
+        routing_key = self.queue if status == CUSTOMER_MESSAGE else self.error_queue
+        connection = self._acquire()
+        try:
+            for body in bodies:
+                connection.publish(routing_key, body, content_type)
+        finally:
+            self._pool.put(connection)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue_module.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.pool_size:
+                connection = AmqpConnectionManager(*self.connection_args)
+                self._connections.append(connection)
+                return connection
+        return self._pool.get()
+
+    def flush(self):
+        for connection in self._connections:
+            connection.flush()
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+
+
+@register_publisher('mqtt')
+class MqttPublisher(Publisher):
+    def __init__(self, host, port, client_id, user, password,
+                 topic='customer_messages', error_topic='error_messages'):
+        super().__init__()
+        self.connection = MqttConnectionManager(host, port, client_id, user, password)
+        self.topic = topic
+        self.error_topic = error_topic
+        self.destination = f"mqtt:{host}:{port}:{topic},{error_topic}"
+
+    def send_encoded(self, status, messages, bodies, dedup_ids=None):
+        topic = self.topic if status == CUSTOMER_MESSAGE else self.error_topic
+        for body in bodies:
+            self.connection.publish(topic, body)
+
+    def send_frame(self, status, body, content_type):
+        # MQTT 3.1.1 has no message properties, so subscribers of packed
+        # topics must be configured with the pack format
+        topic = self.topic if status == CUSTOMER_MESSAGE else self.error_topic
+        self.connection.publish(topic, body)
+
+    def flush(self):
+        self.connection.flush()
+
+    def close(self):
+        self.connection.close()
+
+
+class PackingPublisher(Publisher):
+    """Packs messages into frames and sends each frame as one queue message.
+
+    A frame is sent once it holds ``max_records`` records or the next record
+    would take it over ``max_bytes``, and on flush. Customer messages and
+    error messages are packed separately since they may go to different
+    queues or topics. Like SqsBatchPublisher, a full frame is sent by the
+    thread that filled it.
+    """
+
+    def __init__(self, publisher, format='ndjson', max_records=PACK_MAX_RECORDS, max_bytes=PACK_MAX_BYTES):
+        super().__init__()
+        self.publisher = publisher
+        self.codec = get_codec(format)
+        self.destination = f"{publisher.destination}:{format}"
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.frames_sent = 0
+        self._frames = {CUSTOMER_MESSAGE: [], ERROR_MESSAGE: []}
+        self._bytes = {CUSTOMER_MESSAGE: 0, ERROR_MESSAGE: 0}
+        self._lock = threading.Lock()
+
+    def encode(self, messages):
+        return self.codec.encode_many(messages)
+
+    def send_encoded(self, status, messages, records, dedup_ids=None):
+        full_frames = []
+        with self._lock:
+            for record in records:
+                frame = self._frames[status]
+                if frame and (len(frame) == self.max_records or self._bytes[status] + len(record) > self.max_bytes):
+                    full_frames.append(self._take_frame(status))
+                self._frames[status].append(record)
+                self._bytes[status] += len(record)
+
+        for frame in full_frames:
+            self._send_frame(status, frame)
+
+    def flush(self):
+        with self._lock:
+            frames = [(status, self._take_frame(status)) for status in self._frames if self._frames[status]]
+        for status, records in frames:
+            self._send_frame(status, records)
+        self.publisher.flush()
+
+    def close(self):
+        self.flush()
+        self.publisher.close()
+
+    def _take_frame(self, status):
+        records, self._frames[status], self._bytes[status] = self._frames[status], [], 0
+        return records
+
+    def _send_frame(self, status, records):
+        self.publisher.send_frame(status, b''.join(records), self.codec.content_type)
+        with self._lock:
+            self.frames_sent += 1
@@ -0,0 +1,107 @@
+import sys
+from array import array
+
+# Column-oriented in-memory model of the three daily files. Only the columns
+# the summary needs are kept, references are interned so the orders and items
+# tables share one string object per reference, and prices are parsed into a
+# float array once at load time.
+
+
+def column_positions(rows, key, *names):
+    # Reads the header row; csv.reader yields [] for the blank lines after
+    # it, which the readers below skip like csv.DictReader and pandas do
+    header = next(rows, None)
+    if header is None:
+        raise ValueError(f"'{key}' is empty")
+    missing = [name for name in names if name not in header]
+    if missing:
+        raise ValueError(f"'{key}' is missing columns {missing}")
+    return [header.index(name) for name in names]
+
+
+class Customers:
+    __slots__ = ('references', 'index')
+
+    def __init__(self):
+        self.references = []
+        # customer_reference -> row position
+        self.index = {}
+
+    def __len__(self):
+        return len(self.references)
+
+    def __contains__(self, customer_reference):
+        return customer_reference in self.index
+
+    def append(self, customer_reference):
+        customer_reference = sys.intern(customer_reference)
+        self.index[customer_reference] = len(self.references)
+        self.references.append(customer_reference)
+
+    @classmethod
+    def from_csv(cls, rows, key='customers'):
+        # rows: csv.reader over the file, header first
+        ref, = column_positions(rows, key, 'customer_reference')
+        table = cls()
+        for row in rows:
+            if not row:
+                continue
+            table.append(row[ref])
+        return table
+
+
+class Orders:
+    __slots__ = ('references', 'customer_references', 'index')
+
+    def __init__(self):
+        self.references = []
+        self.customer_references = []
+        # order_reference -> row position
+        self.index = {}
+
+    def __len__(self):
+        return len(self.references)
+
+    def __contains__(self, order_reference):
+        return order_reference in self.index
+
+    def append(self, order_reference, customer_reference):
+        order_reference = sys.intern(order_reference)
+        self.index[order_reference] = len(self.references)
+        self.references.append(order_reference)
+        self.customer_references.append(sys.intern(customer_reference))
+
+    @classmethod
+    def from_csv(cls, rows, key='orders'):
+        ref, customer_ref = column_positions(rows, key, 'order_reference', 'customer_reference')
+        table = cls()
+        for row in rows:
+            if not row:
+                continue
+            table.append(row[ref], row[customer_ref])
+        return table
+
+
+class Items:
+    __slots__ = ('order_references', 'total_prices')
+
+    def __init__(self):
+        self.order_references = []
+        self.total_prices = array('d')
+
+    def __len__(self):
+        return len(self.order_references)
+
+    def append(self, order_reference, total_price):
+        self.order_references.append(sys.intern(order_reference))
+        self.total_prices.append(float(total_price))
+
+    @classmethod
+    def from_csv(cls, rows, key='items'):
+        ref, price = column_positions(rows, key, 'order_reference', 'total_price')
+        table = cls()
+        for row in rows:
+            if not row:
+                continue
+            table.append(row[ref], row[price])
+        return table
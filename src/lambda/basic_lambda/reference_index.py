@@ -0,0 +1,174 @@
+import csv
+import logging
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from botocore.exceptions import ClientError
+
+from parsed_cache import FileCache
+from records import column_positions
+from s3_csv import iter_lines
+
+logger = logging.getLogger()
+
+# A reference index holds the distinct references of one column of an input,
+# e.g. the customer_reference of a customers file, in three flat buffers:
+#
+#   hashes   sorted 64-bit hashes of the references
+#   offsets  start of each reference in blob, plus its end
+#   blob     the UTF-8 references, in the order of their hashes
+#
+# A lookup bisects the hashes and compares the references under an equal
+# hash, so it is exact. It is several times slower than a dict lookup, but an
+# entry takes 16 bytes plus the reference instead of well over 100 for a dict
+# of interned strings, and a saved index is read back in one pass instead of
+# parsing the CSV again. That pays off for a large customers file against
+# few orders a day.
+#
+# Indexes are saved like parsed inputs, named after the kind and ETag of the
+# object they came from, in /tmp and with a bucket also under
+# reference-index/ in S3 for cold containers.
+REFERENCE_INDEX_DIR = '/tmp/reference-index'
+REFERENCE_INDEX_PREFIX = 'reference-index/'
+REFERENCE_INDEX_MAX_BYTES = 128 * 1024 * 1024
+# The column indexed for each input kind
+REFERENCE_COLUMNS = {
+    'customers': 'customer_reference',
+    'orders': 'order_reference',
+}
+
+# Magic, number of references, blob size; the arrays follow little-endian
+_HEADER = struct.Struct('<8sQQ')
+_MAGIC = b'REFIDX1\n'
+_SEED = 0x9e3779b9
+
+_cache = {}
+
+
+def reference_hash(encoded):
+    return zlib.crc32(encoded) << 32 | zlib.crc32(encoded, _SEED)
+
+
+class ReferenceIndex:
+    """Exact set of references in sorted flat arrays; see the comment above."""
+
+    __slots__ = ('hashes', 'offsets', 'blob')
+
+    def __init__(self, hashes, offsets, blob):
+        self.hashes = hashes
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, reference):
+        encoded = reference.encode()
+        key = reference_hash(encoded)
+        hashes = self.hashes
+        position = bisect_left(hashes, key)
+        while position < len(hashes) and hashes[position] == key:
+            if self.blob[self.offsets[position]:self.offsets[position + 1]] == encoded:
+                return True
+            position += 1
+        return False
+
+    @property
+    def index(self):
+        # aggregation.summarize looks references up in table.index, so an
+        # index of customers stands in for records.Customers there
+        return self
+
+    @classmethod
+    def from_references(cls, references):
+        encoded = list({reference.encode() for reference in references})
+        keys = [reference_hash(reference) for reference in encoded]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        encoded = [encoded[position] for position in order]
+        return cls(array('Q', [keys[position] for position in order]),
+                   array('Q', accumulate(map(len, encoded), initial=0)),
+                   b''.join(encoded))
+
+    @classmethod
+    def from_csv(cls, rows, key, column):
+        # rows: csv.reader over the file, header first
+        position, = column_positions(rows, key, column)
+        return cls.from_references(row[position] for row in rows if row)
+
+    def write(self, path):
+        hashes, offsets = self.hashes, self.offsets
+        if sys.byteorder != 'little':
+            hashes, offsets = array('Q', hashes), array('Q', offsets)
+            hashes.byteswap()
+            offsets.byteswap()
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, len(hashes), len(self.blob)))
+            hashes.tofile(f)
+            offsets.tofile(f)
+            f.write(self.blob)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            magic, count, blob_size = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"'{path}' is not a reference index")
+            hashes = array('Q')
+            hashes.fromfile(f, count)
+            offsets = array('Q')
+            offsets.fromfile(f, count + 1)
+            blob = f.read(blob_size)
+        if sys.byteorder != 'little':
+            hashes.byteswap()
+            offsets.byteswap()
+        return cls(hashes, offsets, blob)
+
+
+class ReferenceIndexCache(FileCache):
+    """Saved reference indexes by input kind and ETag."""
+
+    suffix = '.idx'
+
+    def __init__(self, directory=REFERENCE_INDEX_DIR, max_bytes=REFERENCE_INDEX_MAX_BYTES,
+                 s3=None, bucket=None, prefix=REFERENCE_INDEX_PREFIX):
+        super().__init__(directory, max_bytes, s3, bucket, prefix)
+
+    def get(self, kind, etag):
+        path = self.path(kind, etag)
+        return ReferenceIndex.read(path) if path is not None else None
+
+    def put(self, kind, etag, index):
+        self.store(kind, etag, index.write)
+
+    def load(self, kind, etag, open_stream):
+        """Returns the reference index of one input, building it only on a miss.
+
+        ``open_stream`` is called on a miss and must return a binary stream
+        of exactly the object version ``etag`` names.
+        """
+        index = self.get(kind, etag)
+        if index is not None:
+            logger.info(f"Reference index of {kind} {etag} loaded from the cache")
+            return index
+
+        stream = open_stream()
+        try:
+            index = ReferenceIndex.from_csv(csv.reader(iter_lines(stream)), kind, REFERENCE_COLUMNS[kind])
+        finally:
+            stream.close()
+        try:
+            self.put(kind, etag, index)
+        except (OSError, ClientError) as error:
+            # An index that cannot be saved must not fail the run
+            logger.warning(f"Could not save the reference index of {kind} {etag}: {error!r}")
+        return index
+
+
+def get_reference_index_cache(**config):
+    if 'cache' not in _cache:
+        _cache['cache'] = ReferenceIndexCache(**config)
+    return _cache['cache']
@@ -0,0 +1,189 @@
+import codecs
+import csv
+import gzip
+import io
+import logging
+import tempfile
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from import_timer import timed_import
+
+logger = logging.getLogger()
+
+# Bytes pulled from the S3 body per read
+CHUNK_SIZE = 1024 * 1024
+
+# Objects above the threshold are fetched with concurrent ranged GETs
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 8
+
+# Large enough for the three daily files downloading side by side
+S3_MAX_POOL_CONNECTIONS = 3 * MULTIPART_CONCURRENCY
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=MULTIPART_CHUNKSIZE,
+    max_concurrency=MULTIPART_CONCURRENCY)
+
+
+# Inputs may be gzip or zstd compressed, recognised by the key suffix or the
+# object's Content-Encoding. They are decompressed as they are read, so only
+# the compressed bytes are downloaded or spooled. zstd needs the optional
+# zstandard package.
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.gzip': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+# Engines are picked by the size of the decompressed inputs. s3_sender.py
+# stores it with compressed uploads under this metadata key; other objects
+# are assumed to have shrunk by a ratio at the high end of what CSV files
+# get, so a large day errs towards the external engine rather than running
+# out of memory.
+UNCOMPRESSED_SIZE = 'uncompressed-size'
+COMPRESSION_RATIOS = {'gzip': 8, 'zstd': 10}
+
+
+def compression_of(key, content_encoding=None):
+    # Returns 'gzip', 'zstd' or None
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return 'gzip'
+    if encoding == 'zstd':
+        return 'zstd'
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if key.lower().endswith(suffix):
+            return compression
+    return None
+
+
+class _DecompressingStream(io.RawIOBase):
+    # Binary stream over a decompressing reader that also closes the
+    # compressed source on close
+
+    def __init__(self, reader, source):
+        self._reader = reader
+        self._source = source
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._reader.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._reader.close()
+            finally:
+                self._source.close()
+                super().close()
+
+
+def decompressed_size(key, size, content_encoding=None, metadata=None):
+    # Estimated size of an input once decompressed, from its stored size
+    compression = compression_of(key, content_encoding)
+    if compression is None:
+        return size
+    if metadata and metadata.get(UNCOMPRESSED_SIZE):
+        return int(metadata[UNCOMPRESSED_SIZE])
+    return size * COMPRESSION_RATIOS[compression]
+
+
+def decompress(stream, key, content_encoding=None):
+    # Wraps a binary stream in streaming decompression when the key suffix or
+    # Content-Encoding says it is compressed; plain streams are returned as is
+    compression = compression_of(key, content_encoding)
+    if compression == 'gzip':
+        reader = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif compression == 'zstd':
+        zstandard = timed_import('zstandard')
+        reader = zstandard.ZstdDecompressor().stream_reader(stream, read_size=CHUNK_SIZE, closefd=False)
+    else:
+        return stream
+    return io.BufferedReader(_DecompressingStream(reader, stream), CHUNK_SIZE)
+
+
+def iter_lines(body, chunk_size=CHUNK_SIZE, encoding='utf-8'):
+    # Decodes a binary stream chunk by chunk and yields complete lines with
+    # their line endings, so csv can still join quoted multi-line fields.
+    # Only one chunk plus a partial line is held in memory at a time.
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in iter(lambda: body.read(chunk_size), b''):
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def open_s3_object(s3, bucket, key, **get_args):
+    # Returns (stream, size). Small objects are streamed straight from the
+    # GET response. Large ones are downloaded with parallel ranged GETs into
+    # a temp file under /tmp, which is then read back like the response body.
+    # Compressed objects are decompressed while the stream is read; size is
+    # their estimated decompressed size (see decompressed_size). get_args
+    # (e.g. IfMatch) are passed to the first GET only; see open_s3_version.
+    stream, size, _ = open_s3_version(s3, bucket, key, **get_args)
+    return stream, size
+
+
+def open_s3_version(s3, bucket, key, **get_args):
+    # Like open_s3_object, but also returns the ETag of the version read. A
+    # conditional GET that does not match (e.g. IfNoneMatch on an unchanged
+    # object) raises botocore's ClientError.
+    #
+    # download_fileobj does not take conditions, so the ranged GETs of a
+    # large object are pinned another way: on a versioned bucket to the
+    # version of the first GET, and otherwise by a HEAD after the download
+    # that must still find the same ETag. An object replaced while it was
+    # downloaded fails like a GET with IfMatch would, with PreconditionFailed.
+    response = s3.get_object(Bucket=bucket, Key=key, **get_args)
+    stored_size = response['ContentLength']
+    etag = response.get('ETag')
+    content_encoding = response.get('ContentEncoding')
+    size = decompressed_size(key, stored_size, content_encoding, response.get('Metadata'))
+    if stored_size < MULTIPART_THRESHOLD:
+        return decompress(response['Body'], key, content_encoding), size, etag
+
+    response['Body'].close()
+    spool = tempfile.TemporaryFile()
+    version = response.get('VersionId')
+    try:
+        s3.download_fileobj(bucket, key, spool, ExtraArgs={'VersionId': version} if version else None,
+                            Config=TRANSFER_CONFIG)
+        if not version:
+            current = s3.head_object(Bucket=bucket, Key=key).get('ETag')
+            if current != etag:
+                raise ClientError({'Error': {'Code': 'PreconditionFailed',
+                                             'Message': f"'{key}' changed from {etag} to {current} while it "
+                                                        f"was downloaded"},
+                                   'ResponseMetadata': {'HTTPStatusCode': 412}}, 'GetObject')
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return decompress(spool, key, content_encoding), size, etag
+
+
+def read_csv_from_s3(s3, bucket, key, reader=csv.DictReader):
+    # The object is requested right away, so this can run on a worker thread
+    # to start the download; rows are parsed lazily as they are consumed.
+    # Pass reader=csv.reader to get plain lists with the header row first.
+    try:
+        body, _ = open_s3_object(s3, bucket, key)
+    except Exception as e:
+        logger.error(f"Error while reading CSV '{key}' from bucket '{bucket}': {e}")
+        raise
+    return _iter_rows(body, reader)
+
+
+def _iter_rows(body, reader):
+    try:
+        yield from reader(iter_lines(body))
+    finally:
+        body.close()
@@ -0,0 +1,56 @@
+import importlib.util
+import json
+import threading
+
+from import_timer import timed_import
+
+# Outgoing records are encoded to the UTF-8 bytes the publishers put on the
+# wire, one bytes object per record. msgspec or orjson are used when they are
+# installed, in that order, and the standard library otherwise. Every
+# encoder writes compact JSON with the record's keys in their order, so
+# consumers see the same documents whichever one ran.
+JSON_ENCODERS = ('msgspec', 'orjson', 'json')
+_encoder_instances = {}
+_encoder_lock = threading.Lock()
+
+
+class JsonEncoder:
+    """Encodes records to compact JSON bytes with the named library."""
+
+    def __init__(self, name):
+        self.name = name
+        if name == 'orjson':
+            self._encode = timed_import('orjson').dumps
+        elif name == 'msgspec':
+            self._encode = timed_import('msgspec.json').encode
+        else:
+            encode = json.JSONEncoder(separators=(',', ':')).encode
+            self._encode = lambda record: encode(record).encode('utf-8')
+
+    def encode(self, record):
+        return self._encode(record)
+
+    def encode_many(self, records):
+        # One bytes object per record, encoded one after the other
+        encode = self._encode
+        return [encode(record) for record in records]
+
+    def dumps(self, records):
+        # The whole list as one JSON array, e.g. for printing
+        return self._encode(records)
+
+
+def get_json_encoder(name='auto'):
+    if name == 'auto':
+        name = next(name for name in JSON_ENCODERS
+                    if name == 'json' or importlib.util.find_spec(name) is not None)
+    if name not in JSON_ENCODERS:
+        raise ValueError(f"Unknown JSON encoder '{name}', expected 'auto' or one of {list(JSON_ENCODERS)}")
+    encoder = _encoder_instances.get(name)
+    if encoder is None:
+        # Publishers may be built on several threads; only one imports
+        with _encoder_lock:
+            encoder = _encoder_instances.get(name)
+            if encoder is None:
+                encoder = _encoder_instances[name] = JsonEncoder(name)
+    return encoder
@@ -0,0 +1,213 @@
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote_plus
+
+from aggregation import customer_message, missing_order_error
+from engines import get_engine, process
+from records import column_positions
+from s3_csv import decompress, iter_lines, open_s3_object
+
+# Sharded mode splits one day into shards by customer_reference so that each
+# worker only holds its share of the day in memory and time.
+#
+# The coordinator streams the three files once and writes each row into its
+# shard. Customers and orders go to the shard their customer_reference hashes
+# to. Items follow their order, which is the only thing the coordinator keeps
+# in memory (order_reference -> shard). Items of unknown orders become errors
+# right there, so the workers see only items they can attribute.
+#
+# Every worker runs a normal engine over its shard and returns a partial
+# summary. The reduce step merges the partials and appends the coordinator's
+# orphan item errors. The messages are the same as a single-worker run, but
+# customers come out grouped by shard rather than in first-seen order.
+
+# Shards and partial summaries are written under this prefix of the input
+# bucket, in a folder per coordinator run, and deleted once merged
+SHARD_PREFIX = 'shards/'
+PARTIAL_FILE = 'partial.json'
+SHARD_FILES = ('customers.csv', 'orders.csv', 'items.csv')
+SHARD_COLUMNS = (('customer_reference',),
+                 ('customer_reference', 'order_reference'),
+                 ('order_reference', 'total_price'))
+
+
+def shard_of(reference, shard_count):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(reference.encode()) % shard_count
+
+
+def _rows(stream, key, columns):
+    rows = csv.reader(iter_lines(stream))
+    positions = column_positions(rows, key, *columns)
+    for row in rows:
+        if not row:
+            continue
+        yield [row[position] for position in positions]
+
+
+def is_internal_upload(event, prefixes=(SHARD_PREFIX,)):
+    # The bucket notifies the function of every created object, including the
+    # shards, partials and cache files it writes itself; those must not start
+    # another run
+    records = [record for record in (event or {}).get('Records', []) if record.get('eventSource') == 'aws:s3']
+    return bool(records) and all(unquote_plus(record['s3']['object']['key']).startswith(tuple(prefixes))
+                                 for record in records)
+
+
+def split(customers_stream, orders_stream, items_stream, shard_count, out_dir):
+    """Hash-partitions the three streams into ``out_dir/<shard>/``.
+
+    Returns ``(shard_dirs, orphan_errors)``.
+    """
+    shard_dirs = [os.path.join(out_dir, str(shard)) for shard in range(shard_count)]
+    files = []
+    try:
+        writers = []
+        for shard_dir in shard_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+            shard_files = [open(os.path.join(shard_dir, name), 'w', newline='') for name in SHARD_FILES]
+            files.extend(shard_files)
+            shard_writers = [csv.writer(f) for f in shard_files]
+            for writer, columns in zip(shard_writers, SHARD_COLUMNS):
+                writer.writerow(columns)
+            writers.append(shard_writers)
+
+        for customer_reference, in _rows(customers_stream, 'customers', SHARD_COLUMNS[0]):
+            writers[shard_of(customer_reference, shard_count)][0].writerow((customer_reference,))
+
+        # order_reference -> shard, or a tuple of shards for an order
+        # reference that appears under several customers
+        order_shards = {}
+        for row in _rows(orders_stream, 'orders', SHARD_COLUMNS[1]):
+            customer_reference, order_reference = row
+            shard = shard_of(customer_reference, shard_count)
+            writers[shard][1].writerow(row)
+            known = order_shards.setdefault(order_reference, shard)
+            if known != shard and (isinstance(known, int) or shard not in known):
+                order_shards[order_reference] = (known if isinstance(known, tuple) else (known,)) + (shard,)
+
+        orphan_errors = []
+        for row in _rows(items_stream, 'items', SHARD_COLUMNS[2]):
+            shards = order_shards.get(row[0])
+            if shards is None:
+                orphan_errors.append(missing_order_error(row[0]))
+            elif isinstance(shards, int):
+                writers[shards][2].writerow(row)
+            else:
+                for shard in shards:
+                    writers[shard][2].writerow(row)
+    finally:
+        for f in files:
+            f.close()
+        for stream in (customers_stream, orders_stream, items_stream):
+            stream.close()
+    return shard_dirs, orphan_errors
+
+
+def summarize_shard(shard_dir, engine='auto'):
+    # Worker side: returns the shard's (customer_messages, error_messages)
+    paths = [os.path.join(shard_dir, name) for name in SHARD_FILES]
+    engine = get_engine(engine, sum(os.path.getsize(path) for path in paths))
+    return process(engine, *(open(path, 'rb') for path in paths))
+
+
+def merge(partials, orphan_errors=()):
+    """Reduce step: combines the workers' partial summaries.
+
+    Summaries of the same customer are added up, so partials from any split
+    of the day can be merged, not only hash shards.
+    """
+    summary = {}
+    errors = []
+    for customer_messages, error_messages in partials:
+        for message in customer_messages:
+            entry = summary.get(message['customer_reference'])
+            if entry is None:
+                summary[message['customer_reference']] = [message['orders'], message['total_price']]
+            else:
+                entry[0] += message['orders']
+                entry[1] += message['total_price']
+        errors.extend(error_messages)
+    errors.extend(orphan_errors)
+    return [customer_message(ref, orders, total_price) for ref, (orders, total_price) in summary.items()], errors
+
+
+def upload_shards(s3, bucket, prefix, shard_dirs, executor):
+    # Returns the S3 prefix of every shard, e.g. shards/01012000/<request id>/3/
+    prefixes = [f"{prefix}{os.path.basename(shard_dir)}/" for shard_dir in shard_dirs]
+    uploads = [executor.submit(s3.upload_file, os.path.join(shard_dir, name), bucket, shard_prefix + name)
+               for shard_dir, shard_prefix in zip(shard_dirs, prefixes) for name in SHARD_FILES]
+    for upload in uploads:
+        upload.result()
+    return prefixes
+
+
+def invoke_workers(lambda_client, function_name, bucket, prefixes, executor):
+    # Runs one synchronous worker invocation per shard and returns the S3
+    # keys of their partial summaries. Partials go through S3 because a
+    # large shard's summary can exceed the 6 MB invocation response limit.
+    def invoke(prefix):
+        response = lambda_client.invoke(FunctionName=function_name,
+                                        Payload=json.dumps({'shard': {'bucket': bucket, 'prefix': prefix}}))
+        payload = json.load(response['Payload'])
+        if response.get('FunctionError'):
+            raise RuntimeError(f"Shard worker for '{prefix}' failed: {payload}")
+        return payload['partial']
+
+    return list(executor.map(invoke, prefixes))
+
+
+def summarize_s3_shard(s3, bucket, prefix, engine='auto', executor=None):
+    # Worker side in Lambda: summarizes the shard under prefix and stores the
+    # partial summary next to it
+    objects = [open_s3_object(s3, bucket, prefix + name) for name in SHARD_FILES]
+    engine = get_engine(engine, sum(size for _, size in objects))
+    partial = process(engine, *(stream for stream, _ in objects), executor=executor)
+    key = prefix + PARTIAL_FILE
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(partial).encode())
+    return key
+
+
+def read_partials(s3, bucket, keys, executor):
+    def read(key):
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+        try:
+            return json.load(body)
+        finally:
+            body.close()
+
+    return list(executor.map(read, keys))
+
+
+def delete_shards(s3, bucket, prefix):
+    # Deletes whatever a coordinator run wrote under its prefix, also after
+    # a failure part way through the upload or the workers
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+        if not objects:
+            continue
+        response = s3.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+        if response.get('Errors'):
+            raise RuntimeError(f"Could not delete the shards under '{prefix}': {response['Errors'][:3]}")
+
+
+def process_files_sharded(customer_file, orders_file, items_file, shard_count, engine='auto', workers=None):
+    """Runs the sharded mode locally, with a process pool standing in for the
+    Lambda workers."""
+    work_dir = tempfile.mkdtemp(prefix='shards-')
+    try:
+        shard_dirs, orphan_errors = split(*(decompress(open(path, 'rb'), path)
+                                            for path in (customer_file, orders_file, items_file)),
+                                          shard_count, work_dir)
+        with ProcessPoolExecutor(max_workers=workers or min(shard_count, os.cpu_count()),
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            partials = list(executor.map(summarize_shard, shard_dirs, [engine] * shard_count))
+        return merge(partials, orphan_errors)
+    finally:
+        shutil.rmtree(work_dir)
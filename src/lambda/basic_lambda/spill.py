@@ -0,0 +1,216 @@
+import csv
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+
+from aggregation import customer_message, missing_customer_error, missing_order_error
+from records import column_positions
+from s3_csv import iter_lines
+
+# External hash aggregation for days that do not fit in memory. Loading an
+# input streams its rows into partition files on local disk instead of
+# building a table:
+#
+#   customers  customer_reference                        by customer_reference
+#   orders     row, order_reference, customer_reference  by order_reference
+#   items      row, order_reference, total_price         by order_reference
+#
+# Summarizing then runs two passes, each holding one partition at a time.
+# The first joins the orders and items of each order partition into
+# per-order totals and writes them out by customer_reference. The second
+# checks them against the customers of each customer partition and sums
+# them per customer. A partition over SPILL_PARTITION_BYTES is split again
+# with another hash before it is read, so skewed days stay bounded too.
+#
+# Row numbers travel with the rows, so the totals are added in file order and
+# the messages come out in the same order, with the same sums, as from the
+# in-memory engines.
+SPILL_DIR = '/tmp/spill'
+SPILL_PARTITIONS = 64
+SPILL_PARTITION_BYTES = 64 * 1024 * 1024
+# Sub-partitions per oversized partition, and how often one may be split
+SPILL_FANOUT = 8
+SPILL_MAX_DEPTH = 3
+
+
+class Partitions:
+    """Rows of one input, hash-partitioned into CSV files in ``directory``."""
+
+    __slots__ = ('directory', 'paths', 'rows')
+
+    def __init__(self, directory, paths, rows):
+        self.directory = directory
+        self.paths = paths
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def partition_of(reference, count, depth=0):
+    # CRC32 is cheap enough for every row of the inputs. It cannot split a
+    # partition again though: with another seed it only XORs a constant into
+    # the CRC of keys of one length, so all rows of a partition would land in
+    # one sub-partition. Oversized partitions are split with BLAKE2b salted
+    # with their depth instead.
+    encoded = reference.encode()
+    if depth == 0:
+        return zlib.crc32(encoded) % count
+    digest = hashlib.blake2b(encoded, digest_size=8, salt=depth.to_bytes(8, 'little')).digest()
+    return int.from_bytes(digest, 'little') % count
+
+
+class _PartitionWriter:
+    # One csv.writer per partition file, rows routed by the key column
+
+    def __init__(self, directory, count, key, depth=0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.paths = [os.path.join(directory, f'{n}.csv') for n in range(count)]
+        self.key = key
+        self.depth = depth
+        self.rows = 0
+        self._files = [open(path, 'w', newline='') for path in self.paths]
+        self._writers = [csv.writer(f) for f in self._files]
+
+    def write(self, row):
+        self._writers[partition_of(row[self.key], len(self._writers), self.depth)].writerow(row)
+        self.rows += 1
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        return Partitions(self.directory, self.paths, self.rows)
+
+
+def _partition_stream(stream, kind, columns, key, numbered):
+    rows = csv.reader(iter_lines(stream))
+    positions = column_positions(rows, kind, *columns)
+    rows = (row for row in rows if row)
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    writer = _PartitionWriter(tempfile.mkdtemp(prefix=f'{kind}-', dir=SPILL_DIR), SPILL_PARTITIONS, key)
+    try:
+        if numbered:
+            for number, row in enumerate(rows):
+                writer.write([number] + [row[position] for position in positions])
+        else:
+            for row in rows:
+                writer.write([row[position] for position in positions])
+    except BaseException:
+        writer.close().remove()
+        raise
+    return writer.close()
+
+
+def partition_customers(stream):
+    return _partition_stream(stream, 'customers', ('customer_reference',), 0, numbered=False)
+
+
+def partition_orders(stream):
+    return _partition_stream(stream, 'orders', ('order_reference', 'customer_reference'), 1, numbered=True)
+
+
+def partition_items(stream):
+    return _partition_stream(stream, 'items', ('order_reference', 'total_price'), 1, numbered=True)
+
+
+def _read(path):
+    with open(path, newline='') as f:
+        yield from csv.reader(f)
+
+
+def _split(paths, keys, depth, directory):
+    # Splits files that are partitioned alike into SPILL_FANOUT finer
+    # partitions each, hashing at their depth. Returns one group
+    # of matching paths per sub-partition.
+    groups = []
+    for n, (path, key) in enumerate(zip(paths, keys)):
+        writer = _PartitionWriter(os.path.join(directory, str(n)), SPILL_FANOUT, key, depth=depth)
+        for row in _read(path):
+            writer.write(row)
+        groups.append(writer.close().paths)
+    return list(zip(*groups))
+
+
+def _partition_groups(paths, keys, directory, depth=1):
+    # Yields groups of matching partition files that each fit in
+    # SPILL_PARTITION_BYTES, splitting the ones that do not
+    if depth > SPILL_MAX_DEPTH or sum(os.path.getsize(path) for path in paths) <= SPILL_PARTITION_BYTES:
+        yield paths
+        return
+    split_dir = tempfile.mkdtemp(dir=directory)
+    try:
+        for group in _split(paths, keys, depth, split_dir):
+            yield from _partition_groups(group, keys, split_dir, depth + 1)
+    finally:
+        shutil.rmtree(split_dir, ignore_errors=True)
+
+
+def _join_orders(orders_path, items_path, order_totals_writer, missing_order_errors):
+    # Per-order totals of one order partition, written out by customer as
+    # (order row, customer_reference, total, order_reference)
+    orders = [(int(row), reference, customer_reference) for row, reference, customer_reference in _read(orders_path)]
+    order_references = {reference for _, reference, _ in orders}
+    totals = {}
+    for row, reference, total_price in _read(items_path):
+        if reference in order_references:
+            totals[reference] = totals.get(reference, 0.0) + float(total_price)
+        else:
+            missing_order_errors.append((int(row), missing_order_error(reference)))
+    for row, reference, customer_reference in orders:
+        order_totals_writer.write([row, customer_reference, totals.get(reference, 0.0), reference])
+
+
+def _summarize_customers(customers_path, order_totals_path, summary, missing_customer_errors):
+    customers = {row[0] for row in _read(customers_path)}
+    order_totals = sorted((int(row), customer_reference, float(total), reference)
+                          for row, customer_reference, total, reference in _read(order_totals_path))
+    for row, customer_reference, total, reference in order_totals:
+        if customer_reference in customers:
+            entry = summary.get(customer_reference)
+            if entry is None:
+                entry = summary[customer_reference] = [row, 0, 0.0]
+            entry[1] += 1
+            entry[2] += total
+        else:
+            missing_customer_errors.append((row, missing_customer_error(customer_reference, reference)))
+
+
+def summarize_partitions(customers, orders, items):
+    """Summarizes partitioned inputs one partition at a time.
+
+    Returns ``(customer_messages, error_messages)`` like
+    ``aggregation.summarize`` and removes the partition files.
+    """
+    work_dir = tempfile.mkdtemp(prefix='summary-', dir=SPILL_DIR)
+    try:
+        missing_order_errors = []
+        order_totals_writer = _PartitionWriter(os.path.join(work_dir, 'order-totals'), SPILL_PARTITIONS, key=1)
+        try:
+            for orders_path, items_path in zip(orders.paths, items.paths):
+                for group in _partition_groups((orders_path, items_path), (1, 1), work_dir):
+                    _join_orders(*group, order_totals_writer, missing_order_errors)
+        finally:
+            order_totals = order_totals_writer.close()
+
+        # customer_reference -> [first order row, orders, total_price]
+        summary = {}
+        missing_customer_errors = []
+        for customers_path, order_totals_path in zip(customers.paths, order_totals.paths):
+            for group in _partition_groups((customers_path, order_totals_path), (0, 1), work_dir):
+                _summarize_customers(*group, summary, missing_customer_errors)
+
+        entries = sorted(summary.items(), key=lambda item: item[1][0])
+        customer_messages = [customer_message(reference, count, total) for reference, (_, count, total) in entries]
+        missing_customer_errors.sort(key=lambda error: error[0])
+        missing_order_errors.sort(key=lambda error: error[0])
+        return customer_messages, [error for _, error in missing_customer_errors + missing_order_errors]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        for partitions in (customers, orders, items):
+            partitions.remove()
@@ -0,0 +1,166 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import core  # noqa: F401  puts the processing core on sys.path
+from checkpoint import PublishCheckpoint
+from engines import process_files
+from incremental import LocalStateStore
+from packing import PACK_FORMATS
+from publishers import PUBLISH_CONCURRENCY, PUBLISHERS, PackingPublisher, get_publisher, publish_messages
+from serialization import get_json_encoder
+
+# Summarizes many days of customers_/orders_/items_{date}.csv files, e.g. to
+# backfill history. Days run in parallel on a process pool, one day per
+# worker. The parent publishes each day's messages as soon as the day is done,
+# so the broker connections live in a single process.
+
+DATE_FORMAT = "%d%m%Y"
+CUSTOMERS_FILE = re.compile(r"customers_(.+?)(\.csv(?:\.gz|\.gzip|\.zst|\.zstd)?)$")
+# Broker ports used when --port is not given
+DEFAULT_PORTS = {'amqp': 5672, 'mqtt': 1883}
+
+
+def date_range(start, end):
+    day = datetime.datetime.strptime(start, DATE_FORMAT).date()
+    last = datetime.datetime.strptime(end, DATE_FORMAT).date()
+    while day <= last:
+        yield day.strftime(DATE_FORMAT)
+        day += datetime.timedelta(days=1)
+
+
+def day_files(data_dir, file_date, suffix=".csv"):
+    return tuple(os.path.join(data_dir, f"{name}_{file_date}{suffix}") for name in ("customers", "orders", "items"))
+
+
+def date_of(customer_file):
+    return CUSTOMERS_FILE.match(os.path.basename(customer_file)).group(1)
+
+
+def files_from_customers_file(customer_file):
+    # customers_<date>.csv[.gz|.zst] -> the three files of that day
+    match = CUSTOMERS_FILE.match(os.path.basename(customer_file))
+    if not match:
+        raise ValueError(f"'{customer_file}' is not a customers_<date>.csv file")
+    return day_files(os.path.dirname(customer_file), *match.groups())
+
+
+def summarize_day(paths, engine):
+    return process_files(*paths, engine=engine)
+
+
+def publisher_config(args):
+    if args.publisher == "sqs":
+        return {'queue_url': args.queue_url}
+    port = args.port if args.port is not None else DEFAULT_PORTS.get(args.publisher)
+    config = {'host': args.host, 'port': port, 'user': args.user, 'password': args.password}
+    if args.publisher == "amqp":
+        config['virtual_host'] = args.virtual_host
+    elif args.publisher == "mqtt":
+        config['client_id'] = args.client_id
+    return config
+
+
+def backfill(days, workers, engine, publish):
+    """Runs every day on the pool and calls publish(paths, customer_messages,
+    error_messages) as days finish. Returns the days that failed.
+
+    At most two days per worker are pending at once, so finished days cannot
+    pile up in memory while the publisher catches up.
+    """
+    failed = []
+    days = iter(days)
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        while True:
+            for paths in days:
+                pending[executor.submit(summarize_day, paths, engine)] = paths
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                return failed
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                paths = pending.pop(future)
+                try:
+                    customer_messages, error_messages = future.result()
+                except Exception as error:
+                    print(f"Error while reading csv's for {paths[0]}: {error!r}", file=sys.stderr)
+                    failed.append(paths)
+                    continue
+                publish(paths, customer_messages, error_messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize and publish many days of customer order files")
+    days = parser.add_mutually_exclusive_group(required=True)
+    days.add_argument("--dates", nargs=2, metavar=("START", "END"),
+                      help="inclusive date range in DDMMYYYY, read from --data-dir")
+    days.add_argument("--files", nargs="+", metavar="CUSTOMERS_CSV",
+                      help="customers_<date>.csv files; the orders_ and items_ files are read from beside them")
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--suffix", default=".csv", help="file suffix for --dates, e.g. .csv.gz or .csv.zst")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--engine", default="auto")
+    parser.add_argument("--publisher", choices=["print"] + sorted(PUBLISHERS), default="print",
+                        help="'print' writes each day's JSON arrays to stdout")
+    parser.add_argument("--publish-concurrency", type=int, default=PUBLISH_CONCURRENCY)
+    parser.add_argument("--pack", choices=sorted(PACK_FORMATS),
+                        help="pack many records into each queue message in this format")
+    parser.add_argument("--checkpoint", metavar="PATH",
+                        help="dbm file that keeps each day's publish progress, so a rerun skips what was sent")
+    parser.add_argument("--reset-checkpoint", action="store_true",
+                        help="ignore the saved progress and publish every day from the start")
+    parser.add_argument("--queue-url", default="", help="sqs")
+    parser.add_argument("--host", default="", help="amqp, mqtt")
+    parser.add_argument("--port", type=int, help="amqp, mqtt; defaults to 5672 for amqp and 1883 for mqtt")
+    parser.add_argument("--user", default="", help="amqp, mqtt")
+    parser.add_argument("--password", default="", help="amqp, mqtt")
+    parser.add_argument("--virtual-host", default="/", help="amqp")
+    parser.add_argument("--client-id", default="csv_processor", help="mqtt; a random suffix is added to it")
+    args = parser.parse_args()
+
+    if args.dates:
+        day_paths = (day_files(args.data_dir, file_date, args.suffix) for file_date in date_range(*args.dates))
+    else:
+        day_paths = (files_from_customers_file(path) for path in args.files)
+
+    if args.publisher == "print":
+        encoder = get_json_encoder()
+
+        def publish(paths, customer_messages, error_messages):
+            print(encoder.dumps(customer_messages).decode('utf-8'))
+            print(encoder.dumps(error_messages).decode('utf-8'))
+
+        failed = backfill(day_paths, args.workers, args.engine, publish)
+    else:
+        publisher = get_publisher(args.publisher, **publisher_config(args))
+        if args.pack:
+            publisher = PackingPublisher(publisher, args.pack)
+        store = LocalStateStore(args.checkpoint) if args.checkpoint else None
+        published = 0
+
+        def publish(paths, customer_messages, error_messages):
+            nonlocal published
+            checkpoint = None
+            if store is not None:
+                checkpoint = PublishCheckpoint(store, date_of(paths[0]), reset=args.reset_checkpoint)
+            published += publish_messages(publisher, customer_messages, error_messages,
+                                          args.publish_concurrency, checkpoint)
+
+        try:
+            failed = backfill(day_paths, args.workers, args.engine, publish)
+        finally:
+            publisher.close()
+        print(f"Published {published} messages", file=sys.stderr)
+
+    if failed:
+        sys.exit(f"{len(failed)} day(s) failed")
+
+
+if __name__ == "__main__":
+    main()
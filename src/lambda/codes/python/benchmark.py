@@ -0,0 +1,208 @@
+import argparse
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import core  # noqa: F401  puts the processing core on sys.path
+from engines import ENGINES, get_engine, is_available
+from generate_data import add_arguments, generate
+from metrics import peak_rss_mb
+from publishers import PUBLISH_CONCURRENCY, SqsBatchPublisher, publish_messages
+from s3_csv import open_s3_object
+
+# Times the download, parse, summarize (validation + aggregation, which the
+# engines fuse into one pass) and publish stages of every processing engine
+# on seeded synthetic data, and writes the results as a JSON report.
+#
+# S3 and SQS are replaced by local stand-ins, so the numbers measure our
+# code rather than the network. Each run happens in a fresh process, so the
+# engine's import cost and peak RSS are measured from a cold start.
+
+ENGINE_MODULES = {'python': None, 'pandas': 'pandas', 'pyarrow': 'pyarrow'}
+
+
+class LocalS3:
+    """Serves get_object/download_fileobj from a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_object(self, Bucket, Key, **kwargs):
+        path = os.path.join(self.root, Key)
+        return {'Body': open(path, 'rb'), 'ContentLength': os.path.getsize(path)}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs=None, Config=None):
+        with open(os.path.join(self.root, Key), 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+
+class StubSqsClient:
+    """Accepts SendMessageBatch calls, optionally sleeping to mimic the round trip."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+
+def messages_digest(customer_messages, error_messages):
+    # Fingerprint of the messages' contents that does not depend on their
+    # order or on float rounding differences between the engines
+    def canonical(message):
+        if 'total_price' in message:
+            message = dict(message, total_price=round(message['total_price'], 6))
+        return json.dumps(message, sort_keys=True)
+
+    digest = hashlib.sha256()
+    for line in sorted(map(canonical, customer_messages)) + sorted(map(canonical, error_messages)):
+        digest.update(line.encode() + b'\n')
+    return digest.hexdigest()
+
+
+def run_engine(name, data_dir, keys, publish_latency, publish_concurrency):
+    s3 = LocalS3(data_dir)
+    stages = {}
+
+    start = time.perf_counter()
+    engine = get_engine(name)
+    stages['init'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    streams = [open_s3_object(s3, 'local', key)[0] for key in keys]
+    stages['download'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    loaders = (engine.load_customers, engine.load_orders, engine.load_items)
+    tables = []
+    for loader, stream in zip(loaders, streams):
+        tables.append(loader(stream))
+        stream.close()
+    stages['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    customer_messages, error_messages = engine.summarize(*tables)
+    stages['summarize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client = StubSqsClient(publish_latency)
+    publish_messages(SqsBatchPublisher('local', client=client), customer_messages, error_messages,
+                     max_in_flight=publish_concurrency)
+    stages['publish'] = time.perf_counter() - start
+
+    return {
+        'stages_s': stages,
+        'rows': sum(len(table) for table in tables),
+        'customer_messages': len(customer_messages),
+        'error_messages': len(error_messages),
+        'messages_digest': messages_digest(customer_messages, error_messages),
+        'publish_calls': client.calls,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def benchmark(engine_names, data_dir, keys, repeat, publish_latency, publish_concurrency):
+    results = {}
+    for name in engine_names:
+        runs = []
+        for _ in range(repeat):
+            # A fresh process per run keeps import cost and peak RSS honest
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                runs.append(executor.submit(
+                    run_engine, name, data_dir, keys, publish_latency, publish_concurrency).result())
+
+        stages = {stage: statistics.median(run['stages_s'][stage] for run in runs)
+                  for stage in runs[0]['stages_s']}
+        processing = stages['parse'] + stages['summarize']
+        result = {k: v for k, v in runs[0].items() if k not in ('stages_s', 'peak_rss_mb')}
+        result.update({
+            'stages_s': {stage: round(seconds, 6) for stage, seconds in stages.items()},
+            'total_s': round(sum(stages.values()), 6),
+            'rows_per_s': round(result['rows'] / processing) if processing else None,
+            'peak_rss_mb': round(max(run['peak_rss_mb'] for run in runs), 1),
+        })
+        results[name] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing engines on synthetic data")
+    parser.add_argument("--engines", default="all",
+                        help="comma separated engine names, or 'all' for every installed engine")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", help="reuse or keep generated files here instead of a temp dir")
+    parser.add_argument("--publish-latency-ms", type=float, default=0.0,
+                        help="simulated SendMessageBatch round trip")
+    parser.add_argument("--publish-concurrency", type=int, default=PUBLISH_CONCURRENCY)
+    parser.add_argument("--report", default="benchmark_report.json")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.engines == "all":
+        engine_names = [name for name in ENGINES
+                        if ENGINE_MODULES.get(name) is None or is_available(ENGINE_MODULES[name])]
+    else:
+        engine_names = args.engines.split(",")
+
+    file_date = "01012000"
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="benchmark-")
+    paths = generate(data_dir, file_date, args.customers, args.orders_per_customer,
+                     args.items_per_order, args.orphan_rate, args.skew, args.seed)
+    keys = [os.path.basename(path) for path in paths]
+    sizes = {key: os.path.getsize(path) for key, path in zip(keys, paths)}
+
+    try:
+        results = benchmark(engine_names, data_dir, keys, args.repeat,
+                            args.publish_latency_ms / 1000, args.publish_concurrency)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+    digests = {result['messages_digest'] for result in results.values()}
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'data': {
+            'customers': args.customers,
+            'orders_per_customer': args.orders_per_customer,
+            'items_per_order': args.items_per_order,
+            'orphan_rate': args.orphan_rate,
+            'skew': args.skew,
+            'seed': args.seed,
+            'bytes': sizes,
+        },
+        'repeat': args.repeat,
+        'publish_latency_ms': args.publish_latency_ms,
+        'publish_concurrency': args.publish_concurrency,
+        'engines_agree': len(digests) == 1,
+        'results': results,
+    }
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in result['stages_s'].items())
+        print(f"{name:8} {stages} | {result['rows_per_s']} rows/s | {result['peak_rss_mb']} MB peak")
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+# The processing core is shared with the deployed Lambda in
+# src/lambda/basic_lambda. Importing from this module puts that directory on
+# sys.path so the scripts here run the same code as the Lambda.
+import os
+import sys
+
+CORE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'basic_lambda'))
+if CORE_DIR not in sys.path:
+    sys.path.insert(0, CORE_DIR)
+
+from engines import get_engine, process, process_files  # noqa: E402,F401
+from publishers import get_publisher, publish_messages  # noqa: E402,F401
+from s3_csv import open_s3_object  # noqa: E402,F401
+from serialization import get_json_encoder  # noqa: E402,F401
+from sharding import process_files_sharded  # noqa: E402,F401
@@ -0,0 +1,100 @@
+import argparse
+import csv
+import datetime
+import itertools
+import os
+import random
+
+# Seeded generator for synthetic customers_/orders_/items_{date}.csv files in
+# the same layout as ../data. The same arguments always produce the same files.
+
+FIRST_NAMES = ["Alex", "Maria", "John", "Emma", "Liam", "Olivia", "Noah", "Ava", "Mete", "Zeynep"]
+LAST_NAMES = ["Richard", "Johnson", "Doe", "Smith", "Brown", "Garcia", "Miller", "Davis", "Capar", "Yilmaz"]
+ITEM_NAMES = ["XYZ", "ABC", "BBB", "CCC", "DDD", "EEE"]
+ORDER_STATUSES = ["Delivered", "Shipped", "Pending"]
+
+# Orphan references are drawn from a range real references never use
+ORPHAN_OFFSET = 0x80000000
+
+
+def customer_reference(n):
+    h = f"{n:08x}"
+    return f"{h[:4]}-{h[4:]}"
+
+
+def order_reference(n):
+    return f"{n:08x}"
+
+
+def generate(out_dir, file_date, customers=1000, orders_per_customer=5, items_per_order=3,
+             orphan_rate=0.01, skew=0.0, seed=42):
+    """Writes the three CSV files and returns their paths.
+
+    ``orphan_rate`` is the share of orders whose customer is unknown and the
+    share of items whose order is unknown. ``skew`` spreads orders over
+    customers with Zipf-like weights 1 / rank ** skew; 0 is uniform.
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = tuple(os.path.join(out_dir, f"{name}_{file_date}.csv") for name in ("customers", "orders", "items"))
+    customer_path, orders_path, items_path = paths
+
+    with open(customer_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "first_name", "last_name", "customer_reference", "status"])
+        for i in range(customers):
+            writer.writerow([i + 1, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), customer_reference(i), "Active"])
+
+    order_count = customers * orders_per_customer
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(customers)))
+    timestamp = 1676539508
+    with open(orders_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "customer_reference", "order_status", "order_reference", "order_timestamp"])
+        for i in range(order_count):
+            if rng.random() < orphan_rate:
+                customer = ORPHAN_OFFSET + rng.randrange(customers)
+            else:
+                customer = rng.choices(range(customers), cum_weights=cum_weights)[0]
+            writer.writerow([i + 1, customer_reference(customer), rng.choice(ORDER_STATUSES),
+                             order_reference(i), timestamp + i * 100])
+
+    with open(items_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "order_reference", "item_name", "quantity", "total_price"])
+        for i in range(order_count * items_per_order):
+            if rng.random() < orphan_rate:
+                order = ORPHAN_OFFSET + rng.randrange(order_count)
+            else:
+                order = rng.randrange(order_count)
+            quantity = rng.randint(1, 5)
+            writer.writerow([i + 1, order_reference(order), rng.choice(ITEM_NAMES), quantity,
+                             round(quantity * rng.randint(1, 400) / 4, 2)])
+
+    return paths
+
+
+def add_arguments(parser):
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--orders-per-customer", type=int, default=5)
+    parser.add_argument("--items-per-order", type=int, default=3)
+    parser.add_argument("--orphan-rate", type=float, default=0.01)
+    parser.add_argument("--skew", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic customers/orders/items CSV files")
+    parser.add_argument("--out-dir", default="./data")
+    parser.add_argument("--date", default=datetime.datetime.now().strftime("%d%m%Y"))
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    paths = generate(args.out_dir, args.date, args.customers, args.orders_per_customer,
+                     args.items_per_order, args.orphan_rate, args.skew, args.seed)
+    for path in paths:
+        print(f"{path}: {os.path.getsize(path)} bytes")
+
+
+if __name__ == "__main__":
+    main()
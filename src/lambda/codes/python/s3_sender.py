@@ -1,18 +1,212 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
-from botocore.exceptions import NoCredentialsError
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from s3transfer.utils import ChunksizeAdjuster
+
+import core  # noqa: F401  puts the processing core on sys.path
+from import_timer import timed_import
+from s3_csv import UNCOMPRESSED_SIZE
+
+# Uploads local files to S3, e.g. a day's customers_/orders_/items_ CSVs or a
+# directory of backfill files:
+#
+#     python s3_sender.py ./data/*_15042023.csv
+#     python s3_sender.py ./history --prefix history/ --compress gzip
+#
+# Directories are walked recursively and their files keep their relative path
+# under --prefix; single files and glob matches keep their name. All uploads
+# share one transfer manager, so a large file goes up in parts and the parts
+# of every file share UPLOAD_CONCURRENCY connections.
+#
+# A file whose object already holds the same content is skipped. Uploads
+# carry the MD5 of the local file in their metadata, which also covers
+# compressed uploads. Objects without it are compared by ETag: the MD5 of a
+# single-part upload, or the MD5 of the part MD5s and the part count of a
+# multipart one with the chunk size used here.
+UPLOAD_THRESHOLD = 16 * 1024 * 1024
+UPLOAD_CHUNKSIZE = 16 * 1024 * 1024
+UPLOAD_CONCURRENCY = 32
+# Files hashed, compared and compressed side by side
+UPLOAD_WORKERS = 16
+SOURCE_MD5 = 'source-md5'
+COMPRESSED_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+READ_SIZE = 1024 * 1024
+
+
+def expand(paths, prefix=''):
+    # Returns (local path, key) for every file that the paths, globs and
+    # directories name, in a stable order
+    files = {}
+    for argument in paths:
+        matches = sorted(glob.glob(argument, recursive=True))
+        if not matches:
+            raise FileNotFoundError(f"'{argument}' matches no files")
+        for match in matches:
+            if os.path.isdir(match):
+                found = [os.path.join(directory, name) for directory, _, names in os.walk(match) for name in names]
+                named = [(path, os.path.relpath(path, match).replace(os.sep, '/')) for path in sorted(found)]
+            else:
+                named = [(match, os.path.basename(match))]
+            for path, name in named:
+                key = prefix + name
+                path = os.path.normpath(path)
+                if files.setdefault(key, path) != path:
+                    raise ValueError(f"'{files[key]}' and '{path}' would both be uploaded as '{key}'")
+    return [(path, key) for key, path in files.items()]
+
+
+def file_digests(path, chunksize):
+    # Returns the MD5 of the file and the ETag of a multipart upload of it in
+    # parts of chunksize
+    whole = hashlib.md5()
+    parts = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            whole.update(chunk)
+            parts.append(hashlib.md5(chunk).digest())
+    return whole.hexdigest(), f"{hashlib.md5(b''.join(parts)).hexdigest()}-{len(parts)}"
+
+
+def compress(path, compression):
+    # Compressed copy of the file in an anonymous temporary file; gzip
+    # without a timestamp, so the same file always compresses the same way
+    spool = tempfile.TemporaryFile()
+    try:
+        with open(path, 'rb') as source:
+            if compression == 'gzip':
+                with gzip.GzipFile(fileobj=spool, mode='wb', compresslevel=6, mtime=0) as sink:
+                    shutil.copyfileobj(source, sink, READ_SIZE)
+            else:
+                zstandard = timed_import('zstandard')
+                zstandard.ZstdCompressor().copy_stream(source, spool, read_size=READ_SIZE, write_size=READ_SIZE)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+class Uploader:
+    """Uploads files to one bucket, skipping the ones S3 already has."""
+
+    def __init__(self, bucket, compression=None, force=False, concurrency=UPLOAD_CONCURRENCY,
+                 chunksize=UPLOAD_CHUNKSIZE, workers=UPLOAD_WORKERS, s3=None):
+        self.bucket = bucket
+        self.compression = compression
+        self.force = force
+        self.config = TransferConfig(multipart_threshold=UPLOAD_THRESHOLD, multipart_chunksize=chunksize,
+                                     max_concurrency=concurrency)
+        # Enough connections for every part in flight plus the HEAD requests
+        self.s3 = s3 or boto3.client('s3', config=Config(max_pool_connections=concurrency + workers))
+        self.manager = create_transfer_manager(self.s3, self.config)
+        self._adjuster = ChunksizeAdjuster()
+
+    def upload(self, path, key):
+        """Uploads one file unless it is unchanged; returns ``(key, uploaded)``."""
+        if self.compression:
+            key += COMPRESSED_SUFFIXES[self.compression]
+        size = os.path.getsize(path)
+        # The part size s3transfer will use for a file of this size
+        chunksize = self._adjuster.adjust_chunksize(self.config.multipart_chunksize, size)
+        md5, multipart_etag = file_digests(path, chunksize)
+        if not self.force and self._unchanged(key, size, md5, multipart_etag):
+            return key, False
 
-def upload_to_aws(local_file, bucket, s3_file):
-    s3 = boto3.client('s3')
+        extra_args = {'Metadata': {SOURCE_MD5: md5}}
+        if not self.compression:
+            self.manager.upload(path, self.bucket, key, extra_args=extra_args).result()
+            return key, True
+        # The Lambda picks its engine by the decompressed size
+        extra_args['Metadata'][UNCOMPRESSED_SIZE] = str(size)
+        with compress(path, self.compression) as body:
+            self.manager.upload(body, self.bucket, key, extra_args=extra_args).result()
+        return key, True
+
+    def _unchanged(self, key, size, md5, multipart_etag):
+        try:
+            head = self.s3.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        metadata = head.get('Metadata', {})
+        if SOURCE_MD5 in metadata:
+            return metadata[SOURCE_MD5] == md5
+        if self.compression or head['ContentLength'] != size:
+            return False
+        return head['ETag'].strip('"') in (md5, multipart_etag)
+
+    def close(self):
+        self.manager.shutdown()
+
+
+def upload_all(uploader, files, workers=UPLOAD_WORKERS):
+    """Uploads (path, key) pairs side by side, printing one line per file.
+
+    Returns ``(uploaded, unchanged, failed)`` counts; a file that fails does
+    not stop the others.
+    """
+    def upload(path, key):
+        try:
+            return uploader.upload(path, key)
+        except Exception as error:
+            print(f"Failed to upload '{path}': {error!r}", file=sys.stderr)
+            return key, None
+
+    counts = {True: 0, False: 0, None: 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, uploaded in executor.map(lambda file: upload(*file), files):
+            counts[uploaded] += 1
+            if uploaded is not None:
+                print(f"{'uploaded' if uploaded else 'unchanged'} s3://{uploader.bucket}/{key}")
+    return counts[True], counts[False], counts[None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload files, globs or directories to S3.")
+    parser.add_argument("paths", nargs="+", metavar="PATH", help="files, glob patterns or directories")
+    parser.add_argument("--bucket", default="mete-bucket-55")
+    parser.add_argument("--prefix", default="", help="prepended to every key, e.g. history/")
+    parser.add_argument("--compress", choices=sorted(COMPRESSED_SUFFIXES),
+                        help="compress each file while uploading it and add .gz or .zst to its key")
+    parser.add_argument("--force", action="store_true", help="upload files even if S3 has them unchanged")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS, help="files handled side by side")
+    parser.add_argument("--concurrency", type=int, default=UPLOAD_CONCURRENCY,
+                        help="parts uploaded side by side across all files")
+    parser.add_argument("--chunk-size", type=int, default=UPLOAD_CHUNKSIZE // (1024 * 1024), metavar="MB",
+                        help="part size of multipart uploads")
+    args = parser.parse_args()
+
+    try:
+        files = expand(args.paths, args.prefix)
+    except (OSError, ValueError) as error:
+        sys.exit(str(error))
+
+    started = time.perf_counter()
+    uploader = Uploader(args.bucket, args.compress, args.force, args.concurrency,
+                        args.chunk_size * 1024 * 1024, args.workers)
     try:
-        s3.upload_file(local_file, bucket, s3_file)
-        print("Upload Successful")
-        return True
-    except FileNotFoundError:
-        print("The file was not found")
-        return False
-    except NoCredentialsError:
-        print("Credentials not available")
-        return False
-
-
-uploaded = upload_to_aws('Arsiv.zip', 'mete-bucket-55', 'Arsiv.zip')
+        uploaded, unchanged, failed = upload_all(uploader, files, args.workers)
+    finally:
+        uploader.close()
+    print(f"Uploaded {uploaded} file(s), {unchanged} unchanged, in {time.perf_counter() - started:.1f}s",
+          file=sys.stderr)
+
+    if failed:
+        sys.exit(f"{failed} file(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,196 @@
+import argparse
+import importlib
+import json
+import logging
+import signal
+import threading
+import time
+
 import boto3
+from botocore.config import Config
+
+import core  # noqa: F401  puts the processing core on sys.path
+from packing import unpack
+
+logger = logging.getLogger(__name__)
+
+# Drains the summary queue with several long-polling receivers. Each receiver
+# takes up to 10 messages per ReceiveMessage call, hands their records to the
+# handler and deletes the handled messages with one DeleteMessageBatch call.
+# Messages whose handler raised are left alone and come back after their
+# visibility timeout. While a handler is slow, the visibility of the messages
+# in hand is extended so another receiver does not get them too.
+
+RECEIVE_MAX_MESSAGES = 10
+RECEIVE_WAIT_SECONDS = 20
+VISIBILITY_TIMEOUT = 30
+RECEIVERS = 8
+# Longest sleep after repeated ReceiveMessage errors
+MAX_BACKOFF_SECONDS = 20
+
+
+def unpack_message(message):
+    # Returns the records in a received message. Packed frames carry their
+    # format in the ContentType/ContentEncoding message attributes; plain
+    # messages are a single JSON record.
+    attributes = message.get('MessageAttributes', {})
+    return unpack(message['Body'],
+                  attributes.get('ContentType', {}).get('StringValue'),
+                  attributes.get('ContentEncoding', {}).get('StringValue'))
+
+
+def print_records(records):
+    for record in records:
+        print(json.dumps(record))
+
+
+class SqsConsumer:
+    """Long-polling receivers with batched deletes and visibility extension.
+
+    ``handler`` is called with the list of records of one message and may
+    run on several receiver threads at once. ``stop`` lets the receivers
+    finish and delete the messages in hand, then return from ``run``.
+    """
+
+    def __init__(self, queue_url, handler=print_records, receivers=RECEIVERS, client=None,
+                 wait_seconds=RECEIVE_WAIT_SECONDS, visibility_timeout=VISIBILITY_TIMEOUT, exit_when_empty=False):
+        self.queue_url = queue_url
+        self.handler = handler
+        self.receivers = receivers
+        self.client = client or boto3.client('sqs', config=Config(max_pool_connections=receivers + 2))
+        self.wait_seconds = wait_seconds
+        self.visibility_timeout = visibility_timeout
+        self.exit_when_empty = exit_when_empty
+        self.received = 0
+        self.deleted = 0
+        self.failed = 0
+        self._stopping = threading.Event()
+        # receipt handle -> time its visibility runs out
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        threads = [threading.Thread(target=self._receive_loop, name=f'receiver-{n}', daemon=True)
+                   for n in range(self.receivers)]
+        extender = threading.Thread(target=self._extend_loop, name='visibility', daemon=True)
+        for thread in threads:
+            thread.start()
+        extender.start()
+        for thread in threads:
+            thread.join()
+        self._stopping.set()
+        extender.join()
+
+    def _receive_loop(self):
+        errors = 0
+        while not self._stopping.is_set():
+            try:
+                response = self.client.receive_message(
+                    QueueUrl=self.queue_url, MaxNumberOfMessages=RECEIVE_MAX_MESSAGES,
+                    WaitTimeSeconds=self.wait_seconds, VisibilityTimeout=self.visibility_timeout,
+                    MessageAttributeNames=['All'])
+            except Exception as error:
+                errors += 1
+                backoff = min(MAX_BACKOFF_SECONDS, 0.1 * 2 ** errors)
+                logger.warning(f"ReceiveMessage failed ({error!r}), retrying in {backoff:.1f}s")
+                self._stopping.wait(backoff)
+                continue
+            errors = 0
+
+            messages = response.get('Messages', [])
+            if not messages:
+                if self.exit_when_empty:
+                    return
+                continue
+
+            deadline = time.monotonic() + self.visibility_timeout
+            with self._lock:
+                self.received += len(messages)
+                for message in messages:
+                    self._in_flight[message['ReceiptHandle']] = deadline
+
+            handled = []
+            for message in messages:
+                try:
+                    self.handler(unpack_message(message))
+                    handled.append(message)
+                except Exception as error:
+                    logger.error(f"Handler failed for message {message['MessageId']}: {error!r}")
+                    with self._lock:
+                        self.failed += 1
+                        self._in_flight.pop(message['ReceiptHandle'], None)
+            self._delete(handled)
+
+    def _delete(self, messages):
+        if not messages:
+            return
+        entries = [{'Id': str(n), 'ReceiptHandle': message['ReceiptHandle']} for n, message in enumerate(messages)]
+        try:
+            response = self.client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+        except Exception as error:
+            # The messages come back after their visibility timeout
+            logger.error(f"DeleteMessageBatch failed: {error!r}")
+            response = {'Failed': entries}
+        for failure in response.get('Failed', []):
+            if 'Code' in failure:
+                logger.error(f"Could not delete message: {failure['Code']} {failure.get('Message', '')}")
+        with self._lock:
+            self.deleted += len(response.get('Successful', []))
+            for message in messages:
+                self._in_flight.pop(message['ReceiptHandle'], None)
+
+    def _extend_loop(self):
+        # Messages due within a third of the timeout get a fresh timeout
+        interval = self.visibility_timeout / 3
+        while not self._stopping.wait(interval):
+            now = time.monotonic()
+            with self._lock:
+                due = [handle for handle, deadline in self._in_flight.items() if deadline - now < interval]
+                for handle in due:
+                    self._in_flight[handle] = now + self.visibility_timeout
+            for start in range(0, len(due), RECEIVE_MAX_MESSAGES):
+                entries = [{'Id': str(n), 'ReceiptHandle': handle, 'VisibilityTimeout': self.visibility_timeout}
+                           for n, handle in enumerate(due[start:start + RECEIVE_MAX_MESSAGES])]
+                try:
+                    self.client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+                except Exception as error:
+                    logger.warning(f"ChangeMessageVisibilityBatch failed: {error!r}")
+
+
+def load_handler(path):
+    # 'package.module:function'
+    module, _, name = path.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consume customer and error messages from SQS")
+    parser.add_argument("--queue-url", required=True)
+    parser.add_argument("--receivers", type=int, default=RECEIVERS)
+    parser.add_argument("--wait-seconds", type=int, default=RECEIVE_WAIT_SECONDS)
+    parser.add_argument("--visibility-timeout", type=int, default=VISIBILITY_TIMEOUT)
+    parser.add_argument("--handler", help="module:function called with the records of each message; "
+                                          "prints them by default")
+    parser.add_argument("--exit-when-empty", action="store_true", help="stop once the queue is drained")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    consumer = SqsConsumer(args.queue_url, load_handler(args.handler) if args.handler else print_records,
+                           receivers=args.receivers, wait_seconds=args.wait_seconds,
+                           visibility_timeout=args.visibility_timeout, exit_when_empty=args.exit_when_empty)
+    # Ctrl-C or SIGTERM: finish the messages in hand, delete them, then exit
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: consumer.stop())
+
+    started = time.perf_counter()
+    consumer.run()
+    elapsed = time.perf_counter() - started
+    logger.info(f"Received {consumer.received}, deleted {consumer.deleted}, handler failures {consumer.failed} "
+                f"in {elapsed:.1f}s")
+
 
-sqs = boto3.resource('sqs')
-queue_url = ''
-
-while True:
-    messages = sqs.Queue(queue_url).receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=5)
-    
-    if not messages:
-        print('No messages in queue')
-        continue
-    
-    for message in messages:
-        print(message.body)
-        message.delete()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+# The processing core is imported from src/lambda/basic_lambda, as the
+# Lambda and the scripts in src/lambda/codes/python do
+import os
+import sys
+
+CORE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', '..', 'src', 'lambda', 'basic_lambda'))
+if CORE_DIR not in sys.path:
+    sys.path.insert(0, CORE_DIR)
@@ -0,0 +1,48 @@
+import csv
+import importlib.util
+import io
+
+import pytest
+
+from engines import ENGINES, get_engine, process
+from reference_index import ReferenceIndex
+from s3_csv import iter_lines
+from sharding import merge, split, summarize_shard
+
+# Blank lines between rows, as csv.DictReader, pandas and pyarrow skip them
+CUSTOMERS = b"customer_reference\nA\n\nB\n\n"
+ORDERS = b"order_reference,customer_reference\nO1,A\n\nO2,B\nO3,X\n"
+ITEMS = b"order_reference,total_price\n\nO1,4.0\nO2,6.0\n\nO9,1.0\n"
+
+ENGINE_MODULES = {'pandas': 'pandas', 'pyarrow': 'pyarrow'}
+
+
+def streams():
+    return io.BytesIO(CUSTOMERS), io.BytesIO(ORDERS), io.BytesIO(ITEMS)
+
+
+def normalized(customer_messages, error_messages):
+    return (sorted((m['customer_reference'], m['orders'], m['total_price']) for m in customer_messages),
+            sorted((m['order_reference'], m['customer_reference']) for m in error_messages))
+
+
+EXPECTED = ([('A', 1, 4.0), ('B', 1, 6.0)], [('O3', 'X'), ('O9', None)])
+
+
+@pytest.mark.parametrize('name', sorted(ENGINES))
+def test_engines_skip_blank_lines(name):
+    if name in ENGINE_MODULES and importlib.util.find_spec(ENGINE_MODULES[name]) is None:
+        pytest.skip(f'{name} is not installed')
+    assert normalized(*process(get_engine(name), *streams())) == EXPECTED
+
+
+def test_sharding_skips_blank_lines(tmp_path):
+    shard_dirs, orphan_errors = split(*streams(), 2, str(tmp_path))
+    partials = [summarize_shard(shard_dir, 'python') for shard_dir in shard_dirs]
+    assert normalized(*merge(partials, orphan_errors)) == EXPECTED
+
+
+def test_reference_index_skips_blank_lines():
+    index = ReferenceIndex.from_csv(csv.reader(iter_lines(io.BytesIO(CUSTOMERS))), 'customers',
+                                    'customer_reference')
+    assert len(index) == 2 and 'A' in index and 'B' in index
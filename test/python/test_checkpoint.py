@@ -0,0 +1,76 @@
+import pytest
+
+from checkpoint import PublishCheckpoint
+from incremental import LocalStateStore
+from publishers import SqsBatchPublisher, publish_messages
+
+
+class FakeSqs:
+    # Raises like a timed out run on call number fail_at
+    def __init__(self, fail_at=None):
+        self.entries = []
+        self.calls = 0
+        self.fail_at = fail_at
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise TimeoutError('run stopped')
+        self.entries.extend((QueueUrl, entry) for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalStateStore(str(tmp_path / 'state.db'))
+
+
+def day(customers=5):
+    customer_messages = [{'type': 'customer_message', 'customer_reference': f'C{n}', 'orders': 1,
+                          'total_price': float(n)} for n in range(customers)]
+    return customer_messages, []
+
+
+def publish(store, publisher, reset=False):
+    checkpoint = PublishCheckpoint(store, '01012024', every=2, reset=reset)
+    return publish_messages(publisher, *day(), checkpoint=checkpoint)
+
+
+def test_retry_of_a_finished_day_sends_nothing(store):
+    sqs = FakeSqs()
+    publisher = SqsBatchPublisher('https://sqs/q.fifo', client=sqs)
+    assert publish(store, publisher) == 5
+    assert publish(store, publisher) == 0
+    assert len(sqs.entries) == 5
+
+
+def test_each_destination_has_its_own_progress(store):
+    sqs = FakeSqs()
+    publish(store, SqsBatchPublisher('https://sqs/first', client=sqs))
+    assert publish(store, SqsBatchPublisher('https://sqs/second', client=sqs)) == 5
+    assert [url for url, _ in sqs.entries] == ['https://sqs/first'] * 5 + ['https://sqs/second'] * 5
+
+
+def test_reset_sends_again_with_new_dedup_ids(store):
+    sqs = FakeSqs()
+    publisher = SqsBatchPublisher('https://sqs/q.fifo', client=sqs)
+    publish(store, publisher)
+    assert publish(store, publisher, reset=True) == 5
+    first, second = ({entry['MessageDeduplicationId'] for _, entry in sqs.entries[start:start + 5]}
+                     for start in (0, 5))
+    assert not first & second
+    # A retry after the reset resumes the reset run
+    assert publish(store, publisher) == 0
+
+
+def test_run_stopped_mid_window_resumes_at_the_first_unsaved_window(store):
+    # Windows of 2: C0-C1 is saved, C2-C3 fails
+    stopped = FakeSqs(fail_at=2)
+    with pytest.raises(TimeoutError):
+        publish(store, SqsBatchPublisher('https://sqs/q.fifo', client=stopped))
+    assert [entry['MessageGroupId'] for _, entry in stopped.entries] == ['C0', 'C1']
+
+    sqs = FakeSqs()
+    assert publish(store, SqsBatchPublisher('https://sqs/q.fifo', client=sqs)) == 3
+    assert [entry['MessageGroupId'] for _, entry in sqs.entries] == ['C2', 'C3', 'C4']
+    assert sqs.entries[0][1]['MessageDeduplicationId'].endswith(':01012024:c:C2')
@@ -0,0 +1,199 @@
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from incremental import LocalStateStore, confirm_published, locked, parse_s3_event, process_event
+
+CUSTOMERS = "customer_reference,first_name\nA,Ann\nB,Bob\nC,Cem\n"
+ORDERS = "order_reference,customer_reference\nO1,A\nO2,A\nO3,C\nO4,X\n"
+ITEMS = "order_reference,total_price\nO1,4.0\nO2,6.0\nO3,5.0\nO9,1.0\n"
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, key, text):
+        self.objects[key] = text.encode()
+        return hashlib.md5(self.objects[key]).hexdigest()
+
+    def get_object(self, Bucket, Key, **get_args):
+        body = self.objects[Key]
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body),
+                'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalStateStore(str(tmp_path / 'state.db'))
+
+
+def upload(s3, store, *files, published=True):
+    # Uploads (key, text) pairs and applies the S3 event for them, confirming
+    # its messages as published unless published is False
+    records = [{'eventSource': 'aws:s3', 'eventName': 'ObjectCreated:Put',
+                's3': {'bucket': {'name': 'bucket'}, 'object': {'key': key, 'eTag': s3.put(key, text)}}}
+               for key, text in files]
+    deltas = parse_s3_event({'Records': records})
+    messages = process_event(s3, store, deltas)
+    if published:
+        confirm_published(store, deltas)
+    return messages
+
+
+def totals(messages):
+    return {m['customer_reference']: (m['orders'], m['total_price']) for m in messages}
+
+
+def state_of(store, date, *references):
+    found = store.get_many([f'customer:{date}:{reference}' for reference in references])
+    return {reference: (found[f'customer:{date}:{reference}']['orders'],
+                        found[f'customer:{date}:{reference}']['total_price'])
+            for reference in references if f'customer:{date}:{reference}' in found}
+
+
+def test_one_event_matches_the_daily_summary(s3, store):
+    customer_messages, error_messages = upload(
+        s3, store, ('customers_01012024.csv', CUSTOMERS), ('orders_01012024.csv', ORDERS),
+        ('items_01012024.csv', ITEMS))
+    assert totals(customer_messages) == {'A': (2, 10.0), 'C': (1, 5.0)}
+    assert sorted(error['order_reference'] for error in error_messages) == ['O4', 'O9']
+
+
+def test_out_of_order_deltas_end_in_the_same_state(s3, store):
+    _, errors = upload(s3, store, ('items_01012024.csv', ITEMS))
+    assert len(errors) == 4
+    _, errors = upload(s3, store, ('orders_01012024.csv', ORDERS))
+    assert [error['order_reference'] for error in errors] == ['O1', 'O2', 'O3', 'O4']
+    customer_messages, errors = upload(s3, store, ('customers_01012024.csv', CUSTOMERS))
+    assert totals(customer_messages) == {'A': (2, 10.0), 'C': (1, 5.0)}
+    assert errors == []
+    assert state_of(store, '01012024', 'A', 'B', 'C') == {'A': (2, 10.0), 'B': (0, 0.0), 'C': (1, 5.0)}
+
+
+def test_redelivered_event_applies_nothing(s3, store):
+    files = (('customers_01012024.csv', CUSTOMERS), ('orders_01012024.csv', ORDERS), ('items_01012024.csv', ITEMS))
+    upload(s3, store, *files)
+    assert upload(s3, store, *files) == ([], [])
+    assert state_of(store, '01012024', 'A', 'C') == {'A': (2, 10.0), 'C': (1, 5.0)}
+
+
+def test_unpublished_delta_is_sent_again_with_current_totals(s3, store):
+    upload(s3, store, ('customers_01012024.csv', CUSTOMERS))
+    customer_messages, errors = upload(s3, store, ('orders_01012024.csv', ORDERS), published=False)
+    assert totals(customer_messages) == {'A': (2, 0.0), 'C': (1, 0.0)}
+    upload(s3, store, ('items_01012024.csv', ITEMS))
+
+    # The retry of the orders event sends its messages again, not nothing
+    customer_messages, errors = upload(s3, store, ('orders_01012024.csv', ORDERS))
+    assert totals(customer_messages) == {'A': (2, 10.0), 'C': (1, 5.0)}
+    assert [error['order_reference'] for error in errors] == ['O4']
+    assert upload(s3, store, ('orders_01012024.csv', ORDERS)) == ([], [])
+    assert state_of(store, '01012024', 'A', 'C') == {'A': (2, 10.0), 'C': (1, 5.0)}
+
+
+def test_reupload_with_appended_rows_applies_only_the_new_rows(s3, store):
+    upload(s3, store, ('customers_01012024.csv', CUSTOMERS), ('orders_01012024.csv', ORDERS),
+           ('items_01012024.csv', ITEMS))
+    customer_messages, errors = upload(s3, store, ('items_01012024.csv', ITEMS + "O1,1.0\n"))
+    assert totals(customer_messages) == {'A': (2, 11.0)}
+    assert errors == []
+    assert state_of(store, '01012024', 'A', 'C') == {'A': (2, 11.0), 'C': (1, 5.0)}
+
+
+def test_days_are_kept_apart(s3, store):
+    for date in ('01012024', '02012024'):
+        customer_messages, _ = upload(
+            s3, store, (f'customers_{date}.csv', CUSTOMERS), (f'orders_{date}.csv', ORDERS),
+            (f'items_{date}.csv', ITEMS))
+        assert totals(customer_messages) == {'A': (2, 10.0), 'C': (1, 5.0)}
+
+
+def test_run_stopped_after_commit_is_completed_by_the_next_event(s3, store, monkeypatch):
+    upload(s3, store, ('customers_01012024.csv', CUSTOMERS), ('orders_01012024.csv', ORDERS))
+    put_many = store.put_many
+    calls = []
+
+    def stop_after_commit(values):
+        calls.append(values)
+        if len(calls) == 3:
+            raise RuntimeError('stopped')
+        put_many(values)
+
+    monkeypatch.setattr(store, 'put_many', stop_after_commit)
+    with pytest.raises(RuntimeError):
+        upload(s3, store, ('items_01012024.csv', ITEMS))
+    monkeypatch.setattr(store, 'put_many', put_many)
+    assert state_of(store, '01012024', 'A', 'C') == {'A': (2, 0.0), 'C': (1, 0.0)}
+
+    customer_messages, errors = upload(s3, store, ('items_01012024.csv', ITEMS))
+    assert totals(customer_messages) == {'A': (2, 10.0), 'C': (1, 5.0)}
+    assert [error['order_reference'] for error in errors] == ['O9']
+    assert state_of(store, '01012024', 'A', 'C') == {'A': (2, 10.0), 'C': (1, 5.0)}
+
+
+def test_concurrent_deltas_of_one_date_take_turns(s3, store):
+    upload(s3, store, ('customers_01012024.csv', CUSTOMERS))
+    s3.put('orders_01012024.csv', ORDERS)
+    s3.put('items_01012024.csv', ITEMS)
+
+    def apply(key):
+        deltas = parse_s3_event({'Records': [{'eventSource': 'aws:s3', 'eventName': 'ObjectCreated:Put',
+                                              's3': {'bucket': {'name': 'bucket'}, 'object': {'key': key}}}]})
+        with locked(store, deltas):
+            process_event(s3, store, deltas)
+            confirm_published(store, deltas)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(apply, ['orders_01012024.csv', 'items_01012024.csv']))
+    assert state_of(store, '01012024', 'A', 'C') == {'A': (2, 10.0), 'C': (1, 5.0)}
+
+
+def test_lock_waits_for_its_holder(store):
+    with store.lock('date:01012024'):
+        with pytest.raises(TimeoutError):
+            with store.lock('date:01012024', wait=0.1):
+                pass
+        with store.lock('date:02012024', wait=0.1):
+            pass
+    with store.lock('date:01012024', wait=0.1):
+        pass
+
+
+def test_dynamodb_lock_is_taken_over_once_expired(monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+    from incremental import DynamoDBStateStore
+
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        resource = boto3.resource('dynamodb')
+        resource.create_table(TableName='state', KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+                              AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+                              BillingMode='PAY_PER_REQUEST')
+        dynamodb = DynamoDBStateStore('state', resource=resource)
+        with dynamodb.lock('date:01012024'):
+            with pytest.raises(TimeoutError):
+                with dynamodb.lock('date:01012024', wait=0.1):
+                    pass
+        with dynamodb.lock('date:01012024', ttl=-1):
+            # An expired lock whose holder died is taken over
+            with dynamodb.lock('date:01012024', wait=0.1):
+                pass
+        assert 'Item' not in resource.Table('state').get_item(Key={'pk': 'lock:date:01012024'})
+
+
+def test_blank_lines_do_not_shift_appended_rows(s3, store):
+    upload(s3, store, ('customers_01012024.csv', CUSTOMERS), ('orders_01012024.csv', ORDERS))
+    items = "order_reference,total_price\n\nO1,4.0\n\nO2,6.0\n"
+    upload(s3, store, ('items_01012024.csv', items))
+    customer_messages, _ = upload(s3, store, ('items_01012024.csv', items + "O3,5.0\n"))
+    assert totals(customer_messages) == {'C': (1, 5.0)}
+    assert state_of(store, '01012024', 'A', 'C') == {'A': (2, 10.0), 'C': (1, 5.0)}
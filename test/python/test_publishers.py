@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+
+import publishers
+from publishers import (CUSTOMER_MESSAGE, SQS_MAX_BATCH_BYTES, Publisher, PublishEngine, PublishError,
+                        SqsBatchPublisher, publish_messages)
+
+
+class FakeSqs:
+    # failures maps an entry id to the failures returned for it, one per call
+    def __init__(self, failures=None):
+        self.batches = []
+        self.failures = failures or {}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append(Entries)
+        failed = [{'Id': entry['Id'], **self.failures[entry['Id']].pop(0)} for entry in Entries
+                  if self.failures.get(entry['Id'])]
+        failed_ids = {failure['Id'] for failure in failed}
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries if entry['Id'] not in failed_ids],
+                'Failed': failed}
+
+    @property
+    def entries(self):
+        return [entry for batch in self.batches for entry in batch]
+
+
+THROTTLED = {'Code': 'ThrottlingException', 'SenderFault': False}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(publishers.time, 'sleep', lambda seconds: None)
+
+
+def customers(count):
+    return [{'type': 'customer_message', 'customer_reference': f'C{n}', 'orders': 1, 'total_price': 1.0}
+            for n in range(count)]
+
+
+def add(publisher, count, size=10):
+    for n in range(count):
+        publisher.add_body(f'C{n}', 'x' * size)
+
+
+class FailingPublisher(Publisher):
+    def send_encoded(self, status, messages, bodies, dedup_ids=None):
+        # Long enough for the done callback to be registered first
+        threading.Event().wait(0.05)
+        raise RuntimeError('broker down')
+
+
+def test_wait_raises_before_the_done_callbacks_ran(monkeypatch):
+    done = PublishEngine._done
+    callbacks_ran = threading.Event()
+
+    def late_done(self, future):
+        # concurrent.futures wakes wait() before it runs the callbacks
+        threading.Event().wait(0.2)
+        done(self, future)
+        callbacks_ran.set()
+
+    monkeypatch.setattr(publishers.PublishEngine, '_done', late_done)
+    engine = PublishEngine(FailingPublisher(), 2)
+    engine.submit_many(CUSTOMER_MESSAGE, [{'customer_reference': 'A'}])
+    with pytest.raises(RuntimeError, match='broker down'):
+        engine.wait()
+    assert not callbacks_ran.is_set()
+    callbacks_ran.wait(1)
+
+
+def test_batches_hold_at_most_10_entries():
+    sqs = FakeSqs()
+    publisher = SqsBatchPublisher('https://sqs/q', client=sqs)
+    assert publish_messages(publisher, customers(25), [], max_in_flight=3) == 25
+    assert all(len(batch) <= 10 for batch in sqs.batches)
+    assert sorted(entry['Id'] for entry in sqs.entries) == sorted(f'C{n}' for n in range(25))
+    assert publisher.sent == 25
+
+
+def test_batches_hold_at_most_256_kb():
+    sqs = FakeSqs()
+    publisher = SqsBatchPublisher('https://sqs/q', client=sqs)
+    add(publisher, 5, size=100 * 1024)
+    publisher.flush()
+    assert [len(batch) for batch in sqs.batches] == [2, 2, 1]
+    assert all(sum(len(entry['MessageBody']) for entry in batch) <= SQS_MAX_BATCH_BYTES for batch in sqs.batches)
+
+
+def test_only_failed_entries_are_retried():
+    sqs = FakeSqs({'C1': [THROTTLED], 'C3': [THROTTLED, THROTTLED]})
+    publisher = SqsBatchPublisher('https://sqs/q', client=sqs)
+    add(publisher, 5)
+    publisher.flush()
+    assert [[entry['Id'] for entry in batch] for batch in sqs.batches] == \
+        [['C0', 'C1', 'C2', 'C3', 'C4'], ['C1', 'C3'], ['C3']]
+    assert publisher.sent == 5
+
+
+@pytest.mark.parametrize('failures, calls', [
+    ([{'Code': 'InvalidParameterValue', 'SenderFault': True}], 1),
+    ([THROTTLED] * 3, 3),
+])
+def test_flush_raises_for_rejected_entries(failures, calls):
+    sqs = FakeSqs({'C2': failures})
+    publisher = SqsBatchPublisher('https://sqs/q', client=sqs, max_retries=2)
+    add(publisher, 4)
+    with pytest.raises(PublishError, match="first 'C2'"):
+        publisher.flush()
+    assert len(sqs.batches) == calls
+    assert publisher.sent == 3
+    # The failures are reported once
+    publisher.flush()
+
+
+def test_fifo_numbers_identical_bodies():
+    sqs = FakeSqs()
+    publisher = SqsBatchPublisher('https://sqs/q.fifo', client=sqs)
+    # The same missing order for three items gives three identical errors
+    errors = [{'type': 'error_message', 'customer_reference': None, 'order_reference': 'O9',
+               'message': 'Order reference not found'}] * 3
+    for _ in range(2):
+        publish_messages(publisher, [], errors, max_in_flight=2)
+    first, retry = ([entry['MessageDeduplicationId'] for entry in sqs.entries[start:start + 3]] for start in (0, 3))
+    assert len(set(first)) == 3
+    # A rerun numbers them the same way, so SQS drops its copies
+    assert sorted(retry) == sorted(first)
+    assert {entry['MessageGroupId'] for entry in sqs.entries} == {'O9'}
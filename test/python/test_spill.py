@@ -0,0 +1,66 @@
+import io
+import os
+
+import spill
+from engines import get_engine
+
+CUSTOMER_COUNT = 3000
+
+
+def customers_csv():
+    return "customer_reference\n" + "".join(f"C{n:08d}\n" for n in range(CUSTOMER_COUNT))
+
+
+def orders_and_items_csv():
+    orders = ["order_reference,customer_reference"]
+    items = ["order_reference,total_price"]
+    for n in range(CUSTOMER_COUNT * 2):
+        # Every 50th order has a customer that does not exist
+        customer = f"C{n % CUSTOMER_COUNT:08d}" if n % 50 else f"X{n:08d}"
+        orders.append(f"O{n:08d},{customer}")
+        items.append(f"O{n:08d},{n % 7}.5")
+    items.append("O99999999,1.0")
+    return "\n".join(orders) + "\n", "\n".join(items) + "\n"
+
+
+def test_split_spreads_one_partition(tmp_path, monkeypatch):
+    monkeypatch.setattr(spill, 'SPILL_DIR', str(tmp_path))
+    partitions = spill.partition_customers(io.BytesIO(customers_csv().encode()))
+    path = max(partitions.paths, key=os.path.getsize)
+    rows = sum(1 for _ in spill._read(path))
+
+    groups = spill._split([path], [0], 1, str(tmp_path / 'split'))
+    sizes = [sum(1 for _ in spill._read(group[0])) for group in groups]
+    assert sum(sizes) == rows
+    assert len(sizes) == spill.SPILL_FANOUT
+    # Keys of one length share their CRC32 bits; the split must not
+    # follow them into a single sub-partition
+    assert max(sizes) < rows / 2
+
+
+def test_oversized_partitions_are_split_under_the_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(spill, 'SPILL_DIR', str(tmp_path))
+    monkeypatch.setattr(spill, 'SPILL_PARTITIONS', 4)
+    monkeypatch.setattr(spill, 'SPILL_PARTITION_BYTES', 4096)
+    partitions = spill.partition_customers(io.BytesIO(customers_csv().encode()))
+    for path in partitions.paths:
+        assert os.path.getsize(path) > 4096
+        for group in spill._partition_groups((path,), (0,), str(tmp_path)):
+            assert sum(os.path.getsize(member) for member in group) <= 4096
+
+
+def test_external_engine_matches_python_engine_when_splitting(tmp_path, monkeypatch):
+    monkeypatch.setattr(spill, 'SPILL_DIR', str(tmp_path))
+    monkeypatch.setattr(spill, 'SPILL_PARTITIONS', 4)
+    monkeypatch.setattr(spill, 'SPILL_PARTITION_BYTES', 8192)
+    orders, items = orders_and_items_csv()
+    results = []
+    for name in ('python', 'external'):
+        engine = get_engine(name)
+        tables = [engine.load_customers(io.BytesIO(customers_csv().encode())),
+                  engine.load_orders(io.BytesIO(orders.encode())),
+                  engine.load_items(io.BytesIO(items.encode()))]
+        results.append(engine.summarize(*tables))
+    assert results[0] == results[1]
+    assert len(results[0][1]) == CUSTOMER_COUNT * 2 // 50 + 1
+    assert os.listdir(tmp_path) == []